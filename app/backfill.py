@@ -0,0 +1,205 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
+from typing import Callable, Dict, List
+
+from app.models.google import GoogleTask, GoogleTaskLists, GoogleTasks
+from app.models.notion import NotionBuckets, NotionTask, NotionTasks
+from app.models.mongo import (Checkpoint, CheckpointRepository, GoogleTaskRepository,
+                              NotionTaskRepository, Outbox)
+from app.leases import LeaseKeeper
+from app.converters import google_to_notion_task, notion_to_google_task
+from app.syncers.buffer import WriteBuffer
+from app.syncers.merge import MERGE_FIELDS, merge_tasks
+from app.config import settings
+
+logger = settings.logger
+
+
+def match_key(title: str, list_title: str, due: datetime | None) -> tuple:
+    """Tasks with the same title, in a bucket and tasklist of the same name
+    and with the same due date are considered the same task"""
+    return (title, list_title, due.date() if due else None)
+
+
+def parent_first(tasks: Dict[str, object], parent_id: Callable) -> List[List]:
+    """Groups the tasks by depth, so every parent comes before its subtasks.
+
+    Args:
+        tasks (Dict[str, object]): The tasks by id
+        parent_id (Callable): Returns the id of the parent of a task, if any
+
+    Returns:
+        [List[List]]: The tasks of each level, top level first
+    """
+    depths = {}
+
+    def depth(task_id: str) -> int:
+        if task_id not in depths:
+            # Guards against relations going round in circles
+            depths[task_id] = 0
+            parent = parent_id(tasks[task_id])
+            depths[task_id] = depth(parent) + 1 if parent in tasks else 0
+        return depths[task_id]
+
+    levels = defaultdict(list)
+    for task_id, task in tasks.items():
+        levels[depth(task_id)].append(task)
+
+    return [levels[level] for level in sorted(levels)]
+
+
+class Backfill:
+    """Initial import of an existing workspace. Both sides are listed once, the
+    tasks that exist on both sides are paired up and only the missing tasks
+    are created, parents first.
+
+    Tasks that already have an internal task are skipped, so an interrupted
+    backfill is resumed by running it again. The progress is kept in a
+    checkpoint in MongoDB.
+    """
+
+    name = "backfill"
+    batch_size = 50
+
+    checkpoint: Checkpoint
+
+    def __init__(self) -> None:
+        self.buffer = WriteBuffer()
+        self.pool = ThreadPoolExecutor(max_workers=settings.google_pool_size)
+
+        if checkpoint := next(CheckpointRepository.find(name=self.name), None):
+            logger.info(
+                f"Resuming backfill, last checkpoint: {checkpoint.phase} "
+                f"{checkpoint.done}/{checkpoint.total} ({checkpoint.updated})")
+        self.checkpoint = checkpoint or Checkpoint(
+            name=self.name, phase="start", updated=datetime.now())
+
+    def save_checkpoint(self, phase: str, done: int, total: int):
+        self.checkpoint = CheckpointRepository.upsert(Checkpoint(
+            name=self.name, phase=phase, done=done, total=total, updated=datetime.now()
+        ), "name")
+        logger.info(f"Backfill {phase}: {done}/{total}")
+
+    def run(self):
+        # The syncer of the task database must not write at the same time
+        lease = LeaseKeeper(f"database:{settings.notion_task_db}")
+        try:
+            if not lease.acquire():
+                raise RuntimeError(
+                    "Another replica holds the lease of the task database, stop the syncer before the backfill")
+            Outbox.lease = lease.lease
+
+            # Writes left behind by an interrupted run
+            Outbox.drain()
+            self.backfill()
+        finally:
+            Outbox.lease = None
+            lease.release()
+            self.pool.shutdown()
+
+    def backfill(self):
+        """Lists both sides, pairs up the tasks and creates the missing ones"""
+        self.buckets = {bucket.notion_id: bucket.title for bucket in NotionBuckets().list()}
+        self.tasklists = {tasklist.tasklist: tasklist.title for tasklist in GoogleTaskLists.list()}
+
+        synced_notion_ids = set(NotionTaskRepository.find_ids("notion_id"))
+        synced_google_ids = set(GoogleTaskRepository.find_ids("google_id"))
+        notion_tasks = {
+            n_task.notion_id: n_task for n_task in NotionTasks().list_syncable()
+            if n_task.notion_id not in synced_notion_ids
+        }
+        google_tasks = {
+            g_task.google_id: g_task for g_task in GoogleTasks.list()
+            if g_task.google_id not in synced_google_ids
+        }
+        logger.info(f"Backfilling {len(notion_tasks)} Notion task(s) and {len(google_tasks)} Google task(s)")
+
+        self.match(notion_tasks, google_tasks)
+
+        self.create(
+            "google", notion_tasks, self.create_google_task,
+            lambda n_task: n_task.parent_task_ids[0] if n_task.parent_task_ids else None)
+        self.create(
+            "notion", google_tasks, self.create_notion_task,
+            lambda g_task: g_task.parent)
+
+        self.save_checkpoint("done", self.checkpoint.done, self.checkpoint.total)
+
+    def match(self, notion_tasks: Dict[str, NotionTask], google_tasks: Dict[str, GoogleTask]):
+        """Pairs up the tasks that exist on both sides and removes them from
+        the given tasks"""
+        candidates = defaultdict(list)
+        for g_task in google_tasks.values():
+            candidates[match_key(g_task.title, self.tasklists.get(g_task.tasklist), g_task.due)].append(g_task)
+
+        pairs = 0
+        for n_task in list(notion_tasks.values()):
+            key = match_key(
+                n_task.title, self.buckets.get(n_task.bucket_id),
+                n_task.due.datetime() if n_task.due else None)
+            if not candidates.get(key):
+                continue
+
+            g_task = candidates[key].pop(0)
+            del notion_tasks[n_task.notion_id]
+            del google_tasks[g_task.google_id]
+
+            n_task.google_id = g_task.google_id
+            g_task.notion_id = n_task.notion_id
+            # The pair has never been synced. A field set on one side only is
+            # copied to the other side, other differences are resolved by the
+            # conflict policy.
+            merge_tasks(g_task, n_task, g_task, self.buffer,
+                        base_values={field: None for field in MERGE_FIELDS})
+            pairs += 1
+
+        self.buffer.flush()
+        self.save_checkpoint("match", pairs, pairs)
+
+    def create(self, provider: str, tasks: Dict[str, object], create_task: Callable, parent_id: Callable):
+        """Creates the tasks on the provider, level by level and in batches"""
+        total, done = len(tasks), 0
+        for level in parent_first(tasks, parent_id):
+            batches = iter(level)
+            while batch := list(islice(batches, self.batch_size)):
+                # Subtasks of the same parent may be created concurrently, the
+                # parent is done by then
+                done += sum(self.pool.map(create_task, batch))
+                self.save_checkpoint(provider, done, total)
+
+    def create_google_task(self, n_task: NotionTask) -> bool:
+        tasklist_id = None
+        if bucket_title := self.buckets.get(n_task.bucket_id):
+            tasklist_id = next((
+                tasklist_id for tasklist_id, title in self.tasklists.items()
+                if title == bucket_title), None)
+
+        try:
+            n_task.synced = datetime.now()
+            google_task = notion_to_google_task(
+                n_task, tasklist_id=tasklist_id or settings.google_default_tasklist)
+            Outbox.write("google", google_task, linked=n_task)
+            return True
+        except Exception as e:
+            logger.error(f'Could not create "{n_task.title}" in Google: {e}')
+            return False
+
+    def create_notion_task(self, g_task: GoogleTask) -> bool:
+        tasklist_title = self.tasklists.get(g_task.tasklist)
+        bucket_id = next((
+            bucket_id for bucket_id, title in self.buckets.items()
+            if title == tasklist_title), None)
+        if not bucket_id:
+            logger.warning(f'No bucket named "{tasklist_title}", "{g_task.title}" is not created in Notion')
+            return False
+
+        try:
+            g_task.synced = datetime.now()
+            notion_task = google_to_notion_task(g_task, bucket_id=bucket_id)
+            Outbox.write("notion", notion_task, linked=g_task)
+            return True
+        except Exception as e:
+            logger.error(f'Could not create "{g_task.title}" in Notion: {e}')
+            return False
@@ -1,19 +1,77 @@
 import os
 import sys
 import json
+import queue
+import atexit
+import random
 import logging
+from logging.handlers import QueueHandler, QueueListener
 from dotenv import dotenv_values
 
 settings = None
     
-def setup_logger() -> logging.Logger:
-    log_formatter = logging.Formatter("[%(levelname)-5.5s]  %(message)s")
+# Attributes every log record has, anything else was passed with `extra`
+RECORD_ATTRIBUTES = set(logging.makeLogRecord({}).__dict__) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line. Values passed with
+    `extra`, like task ids, become fields of the object."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update({
+            key: value for key, value in record.__dict__.items()
+            if key not in RECORD_ATTRIBUTES
+        })
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SampleFilter(logging.Filter):
+    """Keeps a fraction of the records below WARNING, for loggers that log
+    once per task"""
+
+    def __init__(self, rate: float) -> None:
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+def setup_logger(level: str = "INFO", log_format: str = "text", sample_rate: float = 1) -> logging.Logger:
+    """Sets up the TaskSyncer logger. Records are handed to a queue and
+    written to stdout by a listener thread, so logging doesn't block the
+    sync. The per-task messages go through the "TaskSyncer.task" child
+    logger, which only keeps `sample_rate` of them.
+    """
+    if log_format == "json":
+        log_formatter = JsonFormatter()
+    else:
+        log_formatter = logging.Formatter("[%(levelname)-5.5s]  %(message)s")
     log_handler = logging.StreamHandler(sys.stdout)
     log_handler.setFormatter(log_formatter)
 
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, log_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    # The listener thread doesn't survive a fork, tenant workers start their own
+    os.register_at_fork(after_in_child=lambda: QueueListener(log_queue, log_handler).start())
+
     logger = logging.getLogger("TaskSyncer")
-    logger.addHandler(log_handler)
-    logger.setLevel(logging.DEBUG)
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(level.upper())
+
+    task_logger = logger.getChild("task")
+    task_logger.addFilter(SampleFilter(sample_rate))
     return logger
 
 def read_status_mapper() -> dict:
@@ -31,10 +89,36 @@ def read_status_mapper() -> dict:
 
     return status_mapper
 
+def read_conflict_policies(value: str | None) -> dict:
+    """Parses per-field conflict policies like "notes=notion,status=google"
+    """
+    policies = {}
+    for item in (value or "").split(","):
+        if item.strip():
+            field, policy = item.split("=")
+            policies[field.strip()] = policy.strip()
+
+    return policies
+
+
+def read_scope_intervals(value: str | None) -> dict:
+    """Parses the seconds between syncs of buckets and tasklists, by title,
+    like "Inbox=60,Someday=3600"
+    """
+    intervals = {}
+    for item in (value or "").split(","):
+        if item.strip():
+            title, seconds = item.rsplit("=", 1)
+            intervals[title.strip()] = float(seconds)
+
+    return intervals
+
 
 class BaseSettings():
     # Logger
     logger: logging.Logger
+    # Logger of the messages logged once per task
+    task_logger: logging.Logger
     app_name: str
 
     # Mongo credentials
@@ -47,9 +131,47 @@ class BaseSettings():
     notion_secret: str
     notion_task_db: str
     notion_bucket_db: str
+    notion_http2: bool
+    notion_max_connections: int
+    notion_max_keepalive: int
+    notion_timeout: float
+    notion_connect_timeout: float
+    notion_rate_limit: float
 
     # Google
     google_default_tasklist: str
+    google_pool_size: int
+    google_timeout: float
+    google_rate_limit: float
+    google_tasklists_ttl: float
+
+    # Multi-tenant mode
+    tenant_workers: int
+    lease_ttl: int
+    outbox_max_attempts: int
+
+    # Conflict resolution
+    conflict_policy: str
+    conflict_policies: dict
+
+    # Sync mode
+    sync_mode: str
+    scope_intervals: dict
+    cycle_budget: float
+    due_soon_hours: float
+
+    # Deletion
+    tombstone_grace: float
+    tombstone_batch: int
+    tombstone_batches: int
+    max_delete_ratio: float
+
+    # Memory
+    memory_budget: float
+
+    # Profiling
+    profile_cycles: int
+    profile_dir: str
 
     # Mapper
     status_mapper: dict
@@ -61,7 +183,13 @@ class Settings(BaseSettings):
         print("Loading .env")
         env = dotenv_values(".env")
 
-        self.logger = setup_logger()
+        # LOG_LEVEL, LOG_FORMAT ("text" or "json") and the fraction of the
+        # per-task messages that are logged
+        self.logger = setup_logger(
+            env.get("LOG_LEVEL") or "INFO",
+            env.get("LOG_FORMAT") or "text",
+            float(env.get("LOG_SAMPLE_RATE") or 1))
+        self.task_logger = self.logger.getChild("task")
         self.logger.info("Setting up production environment...")
         self.app_name = "TaskSyncer Notion-Google"
 
@@ -75,9 +203,62 @@ class Settings(BaseSettings):
         self.notion_secret: str = env.get("NOTION_SECRET")
         self.notion_task_db: str = env.get("NOTION_TASK_DB")
         self.notion_bucket_db: str = env.get("NOTION_BUCKET_DB")
+        self.notion_http2: bool = (env.get("NOTION_HTTP2") or "true").lower() == "true"
+        self.notion_max_connections: int = int(env.get("NOTION_MAX_CONNECTIONS") or 10)
+        self.notion_max_keepalive: int = int(env.get("NOTION_MAX_KEEPALIVE") or 10)
+        self.notion_timeout: float = float(env.get("NOTION_TIMEOUT") or 30)
+        self.notion_connect_timeout: float = float(env.get("NOTION_CONNECT_TIMEOUT") or 5)
+        self.notion_rate_limit: float = float(env.get("NOTION_RATE_LIMIT") or 3)
 
         # Google
         self.google_default_tasklist = env.get("GOOGLE_DEFAULT_TASKLIST")
+        self.google_pool_size: int = int(env.get("GOOGLE_POOL_SIZE") or 4)
+        self.google_timeout: float = float(env.get("GOOGLE_TIMEOUT") or 30)
+        self.google_rate_limit: float = float(env.get("GOOGLE_RATE_LIMIT") or 10)
+        self.google_tasklists_ttl: float = float(env.get("GOOGLE_TASKLISTS_TTL") or 60)
+
+        # Multi-tenant mode, disabled when there are no workers
+        self.tenant_workers: int = int(env.get("TENANT_WORKERS") or 0)
+        # Seconds a replica holds a lease without renewing it
+        self.lease_ttl: int = int(env.get("LEASE_TTL") or 60)
+        # Failed provider writes are replayed before every cycle, and dropped
+        # after this many attempts
+        self.outbox_max_attempts: int = int(env.get("OUTBOX_MAX_ATTEMPTS") or 5)
+
+        # Conflict resolution, the policy decides which side wins when a field
+        # is changed on both sides: "notion", "google" or "latest"
+        self.conflict_policy: str = env.get("CONFLICT_POLICY") or "latest"
+        self.conflict_policies: dict = read_conflict_policies(env.get("CONFLICT_POLICIES"))
+
+        # "stream" syncs every listed task, "snapshot" diffs the listing with
+        # the previous one in MongoDB and only syncs the changed tasks
+        self.sync_mode: str = env.get("SYNC_MODE") or "stream"
+        # Buckets and tasklists synced less or more often than every cycle,
+        # the scopes that are not listed are synced every cycle
+        self.scope_intervals: dict = read_scope_intervals(env.get("SCOPE_INTERVALS"))
+        # Seconds a cycle may take. The open tasks due within DUE_SOON_HOURS
+        # of now and the ones edited since the last cycle are always synced,
+        # the other tasks and the deletion pass only within the budget. 0
+        # means no budget
+        self.cycle_budget: float = float(env.get("CYCLE_BUDGET") or 0)
+        self.due_soon_hours: float = float(env.get("DUE_SOON_HOURS") or 24)
+
+        # Seconds a task has to stay missing from the listings before it's
+        # deleted, deletes per batch and batches per cycle, and the fraction of
+        # the tasks that may go missing at once before a listing is treated as
+        # truncated
+        self.tombstone_grace: float = float(env.get("TOMBSTONE_GRACE") or 600)
+        self.tombstone_batch: int = int(env.get("TOMBSTONE_BATCH") or 50)
+        self.tombstone_batches: int = int(env.get("TOMBSTONE_BATCHES") or 4)
+        self.max_delete_ratio: float = float(env.get("MAX_DELETE_RATIO") or 0.5)
+
+        # Megabytes the id sets and pending writes of a cycle may take before
+        # they spill to a temporary sqlite database, 0 means no budget
+        self.memory_budget: float = float(env.get("MEMORY_BUDGET_MB") or 0)
+
+        # Number of sync cycles profiled after startup, see app/profiling.py
+        self.profile_cycles: int = int(env.get("PROFILE_CYCLES") or 0)
+        self.profile_dir: str = env.get("PROFILE_DIR") or "profiles"
 
         # Mapper
         self.status_mapper = read_status_mapper()
@@ -92,7 +273,13 @@ class TestSettings(BaseSettings):
         print("Loading test.env")
         env = dotenv_values("test.env")
 
-        self.logger = setup_logger()
+        # LOG_LEVEL, LOG_FORMAT ("text" or "json") and the fraction of the
+        # per-task messages that are logged
+        self.logger = setup_logger(
+            env.get("LOG_LEVEL") or "INFO",
+            env.get("LOG_FORMAT") or "text",
+            float(env.get("LOG_SAMPLE_RATE") or 1))
+        self.task_logger = self.logger.getChild("task")
         self.logger.info("Setting up test environment...")
         self.app_name = "TaskSyncer Notion-Google (TEST)"
 
@@ -106,9 +293,60 @@ class TestSettings(BaseSettings):
         self.notion_secret: str = env.get("NOTION_SECRET")
         self.notion_task_db: str = env.get("NOTION_TASK_DB")
         self.notion_bucket_db: str = env.get("NOTION_BUCKET_DB")
+        self.notion_http2: bool = (env.get("NOTION_HTTP2") or "true").lower() == "true"
+        self.notion_max_connections: int = int(env.get("NOTION_MAX_CONNECTIONS") or 10)
+        self.notion_max_keepalive: int = int(env.get("NOTION_MAX_KEEPALIVE") or 10)
+        self.notion_timeout: float = float(env.get("NOTION_TIMEOUT") or 30)
+        self.notion_connect_timeout: float = float(env.get("NOTION_CONNECT_TIMEOUT") or 5)
+        self.notion_rate_limit: float = float(env.get("NOTION_RATE_LIMIT") or 3)
 
         # Google
         self.google_default_tasklist = env.get("GOOGLE_DEFAULT_TASKLIST")
+        self.google_pool_size: int = int(env.get("GOOGLE_POOL_SIZE") or 4)
+        self.google_timeout: float = float(env.get("GOOGLE_TIMEOUT") or 30)
+        self.google_rate_limit: float = float(env.get("GOOGLE_RATE_LIMIT") or 10)
+        self.google_tasklists_ttl: float = float(env.get("GOOGLE_TASKLISTS_TTL") or 60)
+
+        # Multi-tenant mode, disabled when there are no workers
+        self.tenant_workers: int = int(env.get("TENANT_WORKERS") or 0)
+        # Seconds a replica holds a lease without renewing it
+        self.lease_ttl: int = int(env.get("LEASE_TTL") or 60)
+        # Failed provider writes are replayed before every cycle, and dropped
+        # after this many attempts
+        self.outbox_max_attempts: int = int(env.get("OUTBOX_MAX_ATTEMPTS") or 5)
+
+        # Conflict resolution, the policy decides which side wins when a field
+        # is changed on both sides: "notion", "google" or "latest"
+        self.conflict_policy: str = env.get("CONFLICT_POLICY") or "latest"
+        self.conflict_policies: dict = read_conflict_policies(env.get("CONFLICT_POLICIES"))
+
+        # "stream" syncs every listed task, "snapshot" diffs the listing with
+        # the previous one in MongoDB and only syncs the changed tasks
+        self.sync_mode: str = env.get("SYNC_MODE") or "stream"
+        # Buckets and tasklists synced less or more often than every cycle,
+        # the scopes that are not listed are synced every cycle
+        self.scope_intervals: dict = read_scope_intervals(env.get("SCOPE_INTERVALS"))
+        # Seconds a cycle may take. The open tasks due within DUE_SOON_HOURS
+        # of now and the ones edited since the last cycle are always synced,
+        # the other tasks and the deletion pass only within the budget. 0
+        # means no budget
+        self.cycle_budget: float = float(env.get("CYCLE_BUDGET") or 0)
+        self.due_soon_hours: float = float(env.get("DUE_SOON_HOURS") or 24)
+
+        # Seconds a task has to stay missing from the listings before it's
+        # deleted, the tests delete tasks in the cycle they go missing in
+        self.tombstone_grace: float = float(env.get("TOMBSTONE_GRACE") or 0)
+        self.tombstone_batch: int = int(env.get("TOMBSTONE_BATCH") or 50)
+        self.tombstone_batches: int = int(env.get("TOMBSTONE_BATCHES") or 4)
+        self.max_delete_ratio: float = float(env.get("MAX_DELETE_RATIO") or 0.5)
+
+        # Megabytes the id sets and pending writes of a cycle may take before
+        # they spill to a temporary sqlite database, 0 means no budget
+        self.memory_budget: float = float(env.get("MEMORY_BUDGET_MB") or 0)
+
+        # Number of sync cycles profiled after startup, see app/profiling.py
+        self.profile_cycles: int = int(env.get("PROFILE_CYCLES") or 0)
+        self.profile_dir: str = env.get("PROFILE_DIR") or "profiles"
 
         # Mapper
         self.status_mapper = read_status_mapper()
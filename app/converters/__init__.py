@@ -5,12 +5,9 @@ from app.config import settings
 
 
 
-status_mapper = settings.status_mapper
-
-
 def notion_to_google_status(n_status: NotionStatus) -> GoogleStatus:
     if n_status:
-        for status in status_mapper:
+        for status in settings.status_mapper:
             if status["notion"]["notion_id"] == n_status.notion_id:
                 return GoogleStatus(status["google"]["name"])
 
@@ -19,26 +16,29 @@ def notion_to_google_status(n_status: NotionStatus) -> GoogleStatus:
 
 
 def google_to_notion_status(g_status: GoogleStatus) -> NotionStatus | None:
-    for status in status_mapper:
+    for status in settings.status_mapper:
         if status["google"]["name"] == g_status.value:
             return NotionStatus(**status["notion"])
 
 
-def notion_to_google_task(n_task: NotionTask) -> GoogleTask:
+def notion_to_google_task(n_task: NotionTask, tasklist_id: str = None) -> GoogleTask:
     """Converts a NotionTask to a GoogleTask. Note, it only takes the fields
     present in both models. NotionTask-model specific fields will not get converted.
 
     Args:
         n_task (NotionTask): The Notion task
+        tasklist_id (str, optional): The tasklist of the task's bucket.
+            Defaults to looking it up.
 
     Returns:
         [GoogleTask]: An instance of a GoogleTask version of sent task
     """
-    try:
-        tasklist_id = GoogleTaskLists.get(
-            title=NotionBuckets.get(n_task.bucket_id).title).tasklist
-    except:
-        tasklist_id = settings.google_default_tasklist
+    if not tasklist_id:
+        try:
+            tasklist_id = GoogleTaskLists.get(
+                title=NotionBuckets.get(n_task.bucket_id).title).tasklist
+        except:
+            tasklist_id = settings.google_default_tasklist
 
     g_parent_id = None
     if n_task.parent_task_ids:
@@ -75,19 +75,22 @@ def notion_to_google_task(n_task: NotionTask) -> GoogleTask:
     return g_task
 
 
-def google_to_notion_task(g_task: GoogleTask) -> NotionTask:
+def google_to_notion_task(g_task: GoogleTask, bucket_id: str = None) -> NotionTask:
     """Converts a GoogleTask to a NotionTask. Note, it only takes the fields
     present in both models. GoogleTask-model specific fields will not get converted. For example, the labels field that is present i NotionTasks
 
     Args:
         n_task (GoogleTask): The Google task
+        bucket_id (str, optional): The bucket of the task's tasklist.
+            Defaults to looking it up.
 
     Returns:
         [NotionTask]: An instance of a NotionTask version of sent task
     """
 
-    bucket_id = NotionBuckets().get_by_title(
-        title=GoogleTaskLists.get(id=g_task.tasklist).title).notion_id
+    if not bucket_id:
+        bucket_id = NotionBuckets().get_by_title(
+            title=GoogleTaskLists.get(id=g_task.tasklist).title).notion_id
 
     n_parents = []
     if g_task.parent:
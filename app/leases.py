@@ -0,0 +1,78 @@
+import os
+import socket
+import threading
+from uuid import uuid4
+
+from app.models.mongo import Lease, LeaseRepository
+from app.config import settings
+
+logger = settings.logger
+
+# Identifies this process among all the replicas sharing the MongoDB
+owner_id = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+
+
+class LeaseKeeper:
+    """Acquires the lease of a resource and keeps it alive from a heartbeat
+    thread until it's released. If a heartbeat fails the lease is considered
+    lost, and another replica may take over once it expires.
+    """
+
+    resource: str
+    ttl: int
+    lease: Lease | None
+
+    def __init__(self, resource: str, ttl: int = None) -> None:
+        self.resource = resource
+        self.ttl = ttl or settings.lease_ttl
+        self.lease = None
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    @property
+    def held(self) -> bool:
+        return self.lease is not None
+
+    def acquire(self) -> bool:
+        """Acquires the lease unless it's already held by this keeper.
+
+        Returns:
+            [bool]: Whether the lease is held
+        """
+        if self.held:
+            return True
+
+        if lease := LeaseRepository.acquire(self.resource, owner_id, self.ttl):
+            logger.info(f"Acquired lease of {self.resource} (token {lease.token})")
+            self.lease = lease
+            self._stop.clear()
+            self._heartbeat = threading.Thread(
+                target=self._beat, name=f"lease-{self.resource}", daemon=True)
+            self._heartbeat.start()
+
+        return self.held
+
+    def release(self):
+        """Stops the heartbeat and releases the lease"""
+        if not self.held:
+            return
+
+        self._stop.set()
+        self._heartbeat.join()
+        # The heartbeat may have lost the lease in the meantime
+        if lease := self.lease:
+            LeaseRepository.release(lease)
+        self.lease = None
+
+    def _beat(self):
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                renewed = LeaseRepository.renew(self.lease, self.ttl)
+            except Exception as e:
+                logger.error(f"Could not renew lease of {self.resource}: {e}")
+                continue
+
+            if not renewed:
+                logger.warning(f"Lost lease of {self.resource}")
+                self.lease = None
+                return
@@ -1,18 +1,69 @@
+import argparse
 from time import sleep
 from app.syncers.google import GoogleSyncer
 from app.syncers.notion import NotionSyncer
+from app.syncers.plan import Plan
+from app.syncers.schedule import ScopeSchedule
+from app.models.mongo import Outbox, LeaseLostError
+from app.leases import LeaseKeeper
+from app.profiling import CycleProfiler
 from app.config import settings
 
 logger = settings.logger
 
 sleep_time = 60
 
+parser = argparse.ArgumentParser(description=settings.app_name)
+parser.add_argument(
+    "--plan", action="store_true",
+    help="list and diff the tasks, log the planned operations and exit without writing anything")
+parser.add_argument(
+    "--profile-cycle", type=int, metavar="N", default=None,
+    help="profile the next N sync cycles and write the profiles to PROFILE_DIR")
+args = parser.parse_args()
+if args.profile_cycle is not None:
+    settings.profile_cycles = args.profile_cycle
+
+if args.plan:
+    plan = NotionSyncer().plan(Plan())
+    GoogleSyncer().plan(plan).log()
+    exit(0)
+
+if settings.tenant_workers:
+    # Multi-tenant mode, the tenants stored in MongoDB are sharded across
+    # worker processes
+    from app.tenants import run_workers
+    run_workers(settings.tenant_workers, sleep_time)
+    exit(0)
+
 # First time syncing
 notion_syncer = NotionSyncer()
 google_syncer = GoogleSyncer()
 
+# Only the replica holding the lease of the task database syncs, the others
+# stand by and take over if it stops renewing the lease
+lease = LeaseKeeper(f"database:{settings.notion_task_db}")
+profiler = CycleProfiler()
+# Buckets and tasklists with their own interval are synced on a schedule
+schedule = ScopeSchedule(sleep_time) if settings.scope_intervals else None
+
 while True:
-    notion_syncer.sync()
-    google_syncer.sync()
-    logger.info(f"Sleeping for {sleep_time} seconds")
-    sleep(sleep_time)
\ No newline at end of file
+    if lease.acquire():
+        Outbox.lease = lease.lease
+        try:
+            with profiler.cycle():
+                # Replay the provider writes left behind by crashes or failed writes
+                Outbox.drain()
+                if schedule:
+                    schedule.sync(notion_syncer, google_syncer)
+                else:
+                    notion_syncer.sync()
+                    google_syncer.sync()
+        except LeaseLostError as e:
+            # Another replica took over in the middle of the cycle
+            logger.warning(str(e))
+    else:
+        logger.info("Another replica is syncing, standing by")
+    wait = schedule.wait() if schedule and lease.held else sleep_time
+    logger.info(f"Sleeping for {wait:.0f} seconds")
+    sleep(wait)
\ No newline at end of file
@@ -1,17 +1,28 @@
+import json
+import threading
 from os import path
 from enum import Enum
 from datetime import datetime
+from functools import lru_cache
+from queue import Full, Queue
+from time import monotonic
 from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor
 
-from google.auth.transport.requests import Request
+import httplib2
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build_from_document, DISCOVERY_URI
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.errors import HttpError
 from mongomantic import MongoDBModel
 
+from app.config import settings
+from app.ratelimit import RateLimiter
+
 # If modifying these scopes, delete the file token.json.
 SCOPES = ['https://www.googleapis.com/auth/tasks']
 
-creds = None
 # The file token.json stores the user's access and refresh tokens, and is
 # created automatically when the authorization flow completes for the first
 # time.
@@ -19,19 +30,108 @@ creds = None
 dirname = path.dirname(__file__)
 credentials_path = path.join(dirname, "../google_api_credentials.json")
 token_path = path.join(dirname, "../token.json")
-if path.exists(credentials_path) and path.exists(token_path):
-    creds = Credentials.from_authorized_user_file(token_path, SCOPES)
-# If there are no (valid) credentials available, let the user log in.
-if not creds or not creds.valid:
-    if creds and creds.expired and creds.refresh_token:
-        creds.refresh(Request())
-    else:
-        raise RuntimeError("You have to setup Google credentials by running google_setup.py manually")
-    # Save the credentials for the next run
-    with open(token_path, 'w') as token:
-        token.write(creds.to_json())
+discovery_path = path.join(dirname, "../google_tasks_discovery.json")
+
+
+class StoredCredentials(Credentials):
+    """Credentials that are written back to token.json whenever they are
+    refreshed"""
+
+    def refresh(self, request):
+        super().refresh(request)
+        # Save the credentials for the next run
+        with open(token_path, 'w') as token:
+            token.write(self.to_json())
+
+
+_creds_lock = threading.Lock()
+creds: Credentials = None
+
+
+def use_google_credentials(credentials: Credentials):
+    """Replaces the Google credentials used by all the Google models"""
+    global creds
+    with _creds_lock:
+        creds = credentials
+
+
+def google_credentials() -> Credentials:
+    """Loads the Google credentials the first time they are needed. Expired
+    credentials are not refreshed here, the transport refreshes them right
+    before the first request that needs them.
+    """
+    global creds
+    with _creds_lock:
+        if creds is None:
+            if not (path.exists(credentials_path) and path.exists(token_path)):
+                raise RuntimeError("You have to setup Google credentials by running google_setup.py manually")
+
+            stored_creds = StoredCredentials.from_authorized_user_file(token_path, SCOPES)
+            if not stored_creds.valid and not stored_creds.refresh_token:
+                raise RuntimeError("You have to setup Google credentials by running google_setup.py manually")
+            creds = stored_creds
+    return creds
+
+
+@lru_cache(maxsize=None)
+def discovery_document() -> dict:
+    """Returns the Google Tasks discovery document. It's taken from the local
+    cache or the documents bundled with the API client, and only downloaded
+    (and cached) if neither is available.
+    """
+    if path.exists(discovery_path):
+        with open(discovery_path, "r") as f:
+            return json.load(f)
+
+    if document := get_static_doc("tasks", "v1"):
+        return json.loads(document)
+
+    discovery_url = DISCOVERY_URI.format(api="tasks", apiVersion="v1")
+    response, content = httplib2.Http(timeout=settings.google_timeout).request(discovery_url)
+    if response.status != 200:
+        raise RuntimeError(f"Could not download the Google Tasks discovery document (HTTP {response.status})")
+    # Only a valid document is cached, a broken cache would fail every start
+    document = json.loads(content)
+    if "resources" not in document:
+        raise RuntimeError("The downloaded Google Tasks discovery document is not valid")
+
+    with open(discovery_path, "wb") as f:
+        f.write(content)
+    return document
 
-client = build("tasks", "v1", credentials=creds)
+
+# Shared by all Google clients of this process
+google_rate_limiter = RateLimiter(settings.google_rate_limit)
+
+
+class RateLimitedHttp(httplib2.Http):
+    """httplib2 transport with a per process rate limit"""
+
+    def request(self, *args, **kwargs):
+        google_rate_limiter.acquire()
+        return super().request(*args, **kwargs)
+
+
+# httplib2 is not thread-safe, every thread gets its own discovery client.
+# Each client keeps its connection to Google alive between requests, so the
+# pool below bounds both the concurrency and the number of open connections.
+_thread_local = threading.local()
+google_pool = ThreadPoolExecutor(
+    max_workers=settings.google_pool_size, thread_name_prefix="google")
+
+
+def google_client():
+    """Returns the Google Tasks client of the current thread"""
+    credentials = google_credentials()
+    if not hasattr(_thread_local, "clients"):
+        _thread_local.clients = {}
+    if credentials not in _thread_local.clients:
+        # First call in this thread with these credentials. Switching between
+        # the credentials of tenants keeps the clients of each tenant.
+        http = AuthorizedHttp(
+            credentials, http=RateLimitedHttp(timeout=settings.google_timeout))
+        _thread_local.clients[credentials] = build_from_document(discovery_document(), http=http)
+    return _thread_local.clients[credentials]
 
 
 def to_python_timestamp(google_timestamp) -> datetime:
@@ -43,10 +143,41 @@ def to_google_timestamp(timestamp: datetime) -> str:
 
 def fetch_google_tasklis_ids() -> List[str]:
     """Fetches up to 100 tasklist ids from Google"""
-    res = client.tasklists().list(maxResults=100).execute()
+    res = google_client().tasklists().list(maxResults=100).execute()
     return list(map(lambda lists_res: lists_res["id"], res["items"]))
 
 
+class GoogleConflictError(Exception):
+    """The task has changed on Google since it was read. Note, it's not a
+    RuntimeError, which the syncers take for a missing parent.
+    """
+
+
+def execute_if(request, header: str, etag: str | None):
+    """Executes a Google request, conditional on the etag of the resource if
+    there is one.
+
+    Args:
+        request: The request to execute
+        header (str): "If-Match" or "If-None-Match"
+        etag (str, optional): The etag of the resource as it was read
+
+    Returns:
+        [dict]: The response, or None if the resource is not modified
+    """
+    if etag:
+        request.headers[header] = etag
+
+    try:
+        return request.execute()
+    except HttpError as e:
+        if e.resp.status == 304:
+            return None
+        if e.resp.status == 412:
+            raise GoogleConflictError("The task has changed on Google since it was read") from e
+        raise
+
+
 class GoogleStatus(str, Enum):
     done = "completed"
     todo = "needsAction"
@@ -65,6 +196,7 @@ class GoogleTask(MongoDBModel):
     notes: str | None = None
     parent: str | None = None
     updated: datetime | None = None
+    etag: str | None = None
     
 
     # Metafields
@@ -73,9 +205,13 @@ class GoogleTask(MongoDBModel):
 
     class Meta:
         google_fields = [
-            "title", "due", "notes", "status", "parent", "updated"
+            "title", "due", "notes", "status", "parent", "updated", "etag"
         ]
         internal_fields = ["id", "synced", "notion_id"]
+        # The fields that can be changed through tasks().patch
+        patch_fields = ["title", "due", "notes", "status"]
+        # The fields edited by users
+        content_fields = ["title", "due", "notes", "status", "parent"]
 
     @classmethod
     def google_to_kwargs(cls, tasklist_id: str, response: dict) -> dict:
@@ -121,18 +257,31 @@ class GoogleTask(MongoDBModel):
             "due": to_google_timestamp(self.due) if self.due else None
         }
 
-    def google_save(self):
+    def google_save(self, fields: List[str] = None):
         """Saves the google task to Google. If the task already exists, it's
-        updated. Otherwise it's created. Returns the new task.
+        patched. Otherwise it's created. Returns the new task.
+
+        Args:
+            fields (List[str], optional): Only patch these fields of an
+                existing task. Defaults to all fields.
         """
         # Does the task exist already on Google?
         body = self.to_google()
         if self.google_id:
-            # Update the task
-            res = client.tasks().update(tasklist=self.tasklist, task=self.google_id, body=body).execute()
+            if fields is not None:
+                if not fields:
+                    return self
+                # Only send the changed fields
+                body = {field: value for field, value in body.items() if field in fields}
+            body["id"] = self.google_id
+            body.pop("parent", None)
+            # Fails instead of overwriting changes made since the task was read
+            res = execute_if(
+                google_client().tasks().patch(tasklist=self.tasklist, task=self.google_id, body=body),
+                "If-Match", self.etag)
         else:
             # Create the task
-            res = client.tasks().insert(tasklist=self.tasklist, body=body, parent=self.parent).execute()
+            res = google_client().tasks().insert(tasklist=self.tasklist, body=body, parent=self.parent).execute()
         
         new_params = self.google_to_kwargs(self.tasklist, res)
         old_params = self.dict()
@@ -149,7 +298,7 @@ class GoogleTask(MongoDBModel):
             RuntimeError: If the given task does not have a google_id
         """
         if self.google_id:
-            client.tasks().delete(tasklist=self.tasklist, task=self.google_id).execute()
+            google_client().tasks().delete(tasklist=self.tasklist, task=self.google_id).execute()
         else:
             raise RuntimeError("The google id is not present")
 
@@ -164,7 +313,7 @@ class GoogleTask(MongoDBModel):
             RuntimeError: If the parent task id is invalid
         """
         try:
-            res = client.tasks().move(
+            res = google_client().tasks().move(
                 tasklist=self.tasklist,
                 task=self.google_id,
                 parent=parent
@@ -198,9 +347,24 @@ class GoogleTask(MongoDBModel):
 
         return self.from_dict(new_params)
 
+    def changed_fields(self, other, fields: List[str] = None) -> List[str]:
+        """Returns the fields that differ from the other task. Defaults to the
+        fields that can be patched.
+        """
+        fields = fields or self.Meta.patch_fields
+        params, other_params = self.dict(include=set(fields)), other.dict(include=set(fields))
+        return [field for field in fields if params[field] != other_params[field]]
+
     def fetch(self):
-        """Fetches this GoogleTask from Google and returns an updated version"""
-        google_res = client.tasks().get(tasklist=self.tasklist, task=self.google_id).execute()
+        """Fetches this GoogleTask from Google and returns an updated version.
+        The task is only downloaded if its etag has changed.
+        """
+        google_res = execute_if(
+            google_client().tasks().get(tasklist=self.tasklist, task=self.google_id),
+            "If-None-Match", self.etag)
+        if google_res is None:
+            return self.from_dict(self.dict())
+
         new_params = self.google_to_kwargs(self.tasklist, google_res)
         old_params = self.dict()
 
@@ -222,7 +386,7 @@ class GoogleTaskLists(MongoDBModel):
         Yields:
             [GoogleTaskList]: One task list at a time
         """
-        res = client.tasklists().list(maxResults=100, **kwargs).execute()
+        res = google_client().tasklists().list(maxResults=100, **kwargs).execute()
         if items := res.get("items"):
             for tasklist in items:
                 try:
@@ -236,7 +400,7 @@ class GoogleTaskLists(MongoDBModel):
     @classmethod
     def get(cls, id:str=None, title:str=None) -> GoogleTaskList:
         if id:
-            res = client.tasklists().get(tasklist=id).execute()
+            res = google_client().tasklists().get(tasklist=id).execute()
             return cls.Meta.model(
                 tasklist=res["id"],
                 title=res["title"]
@@ -247,35 +411,125 @@ class GoogleTaskLists(MongoDBModel):
                 return tasklist
 
 
+class CachedTasklists:
+    """The Google tasklists, listed when they are first needed and listed
+    again once they are older than the configured TTL, so new tasklists are
+    picked up without a restart
+    """
+
+    def __init__(self) -> None:
+        self.tasklists = None
+        self.listed = None
+
+    def __get__(self, instance, owner) -> List[GoogleTaskList]:
+        if self.tasklists is None or monotonic() - self.listed > settings.google_tasklists_ttl:
+            self.tasklists = list(GoogleTaskLists.list())
+            self.listed = monotonic()
+        return self.tasklists
+
+    def clear(self):
+        self.tasklists = None
+
+
+google_tasklists = CachedTasklists()
+
+
 class GoogleTasks(MongoDBModel):
     class Meta:
         model: GoogleTask = GoogleTask
-        tasklists: List[GoogleTaskList] = list(GoogleTaskLists().list())
+        tasklists: List[GoogleTaskList] = google_tasklists
+
+    @classmethod
+    def list_pages(cls, tasklist_id: str, **kwargs):
+        """Returns a generator of the pages of tasks in the given tasklist
+
+        Yields:
+            [List[dict]]: The Google task responses of one page at a time
+        """
+        page_token = None
+        while True:
+            google_res = google_client().tasks().list(
+                tasklist=tasklist_id, maxResults=100, pageToken=page_token, **kwargs).execute()
+            yield google_res.get("items", [])
+
+            # Only one page is kept in memory at a time
+            if not (page_token := google_res.get("nextPageToken")):
+                break
 
     @classmethod
     def list(cls, tasklist_id:str=None, **kwargs):
         """Returns a generator function of the tasks of the given tasklist. If
-        no tasklist is specified all tasks are returned.
+        no tasklist is specified all tasks are returned. The tasklists are
+        then fetched concurrently on the Google pool, and the tasks are
+        yielded in the order their pages arrive.
 
         Yields:
             [GoogleTask]: On task at a time
         """
         if tasklist_id:
-            tasklists_ids = [tasklist_id]
-        else:
-            tasklists_ids = [tasklist.tasklist for tasklist in cls.Meta.tasklists]
-
-        for tasklist_id in tasklists_ids:
-            google_res = client.tasks().list(tasklist=tasklist_id, maxResults=100, **kwargs).execute()
-            if google_res.get("items"):
-                for task in google_res["items"]:
+            for page in cls.list_pages(tasklist_id, **kwargs):
+                for task in page:
                     try:
                         yield cls.Meta.model.from_google(
                             tasklist_id=tasklist_id, google_task=task)
                     except GeneratorExit:
                         pass
+            return
+
+        tasklists_ids = [tasklist.tasklist for tasklist in cls.Meta.tasklists]
+        # Bounded, so fetching never runs far ahead of the consumer
+        pages = Queue(maxsize=settings.google_pool_size * 2)
+        closed = threading.Event()
+
+        def put(item):
+            while not closed.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                    return
+                except Full:
+                    continue
+
+        def fetch(tasklist_id: str):
+            try:
+                for page in cls.list_pages(tasklist_id, **kwargs):
+                    if closed.is_set():
+                        break
+                    put((tasklist_id, page))
+            finally:
+                # Marks the tasklist as done
+                put(None)
+
+        futures = [google_pool.submit(fetch, tasklist_id) for tasklist_id in tasklists_ids]
+
+        try:
+            remaining = len(futures)
+            while remaining:
+                if (item := pages.get()) is None:
+                    remaining -= 1
+                    continue
+
+                tasklist_id, page = item
+                for task in page:
+                    yield cls.Meta.model.from_google(
+                        tasklist_id=tasklist_id, google_task=task)
+
+            # Raise the errors of the fetches, if any
+            for future in futures:
+                future.result()
+        finally:
+            # Stops the fetches if the generator is closed early
+            closed.set()
+            for future in futures:
+                future.cancel()
     
     @classmethod
-    def get(cls, tasklist_id: str, task_id: str, **kwargs) -> GoogleTask:
-        res = client.tasks().get(tasklist=tasklist_id, task=task_id, **kwargs).execute()
+    def get(cls, tasklist_id: str, task_id: str, etag: str = None, **kwargs) -> GoogleTask | None:
+        """Gets a task from Google. If an etag is given, None is returned when
+        the task has not changed since.
+        """
+        res = execute_if(
+            google_client().tasks().get(tasklist=tasklist_id, task=task_id, **kwargs),
+            "If-None-Match", etag)
+        if res is None:
+            return None
         return GoogleTask.from_google(tasklist_id=tasklist_id, google_task=res)
@@ -1,22 +1,35 @@
 
+from datetime import datetime, timedelta, timezone
 from urllib.parse import quote_plus
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from mongomantic import BaseRepository
 from mongomantic import connect as connect_mongo
+from mongomantic.core.database import MongomanticClient
 from mongomantic.core.errors import WriteError
 from mongomantic.core.mongo_model import MongoDBModel
 from mongomantic.core.base_repository import Index
-from typing import List, Type
+from typing import List, Tuple, Type
 
 
 from app.config import settings
 from app.models.notion import NotionTask
-from app.models.google import GoogleTask
+from app.models.google import GoogleConflictError, GoogleTask
 
 # Setup MongoDB connection
 mongo_uri = f"mongodb://{quote_plus(settings.mongo_username)}:{quote_plus(settings.mongo_password)}@{settings.mongo_url}"
 
 connect_mongo(mongo_uri, settings.mongo_db) 
 
+
+def use_mongo_db(database: str):
+    """Switches all repositories to another database of the same MongoDB
+    connection"""
+    MongomanticClient.db = MongomanticClient.client[database]
+    for repository in ExtendedRepository.__subclasses__():
+        # Make sure the indexes get created in the new database
+        repository._indexes = None
+
 class ExtendedRepository(BaseRepository):
 
     class Meta:
@@ -51,12 +64,46 @@ class ExtendedRepository(BaseRepository):
 
         return cls.Meta.model.from_mongo(document)
 
+    @classmethod
+    def upsert(cls, model, id_field: str):
+        """Inserts the model, or updates the entry with the same `id_field`
+        value if there is one. Upserting the same model twice leaves a single
+        entry behind.
+        """
+        try:
+            document = model.to_mongo()
+            res = cls._get_collection().find_one_and_update(
+                {id_field: document[id_field]},
+                {"$set": document},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except Exception as e:
+            raise WriteError(f"Error upserting document: \n{e}")
+
+        return cls.Meta.model.from_mongo(res)
+
+    @classmethod
+    def find_ids(cls, id_field: str, **kwargs):
+        """Returns a generator of the `id_field` values of the entries matching
+        the given filter. Only the id field is fetched from MongoDB, the
+        documents are never turned into models.
+
+        Yields:
+            [str]: One id at a time
+        """
+        cursor = cls._get_collection().find(kwargs, {id_field: 1, "_id": 0})
+        for document in cursor:
+            if task_id := document.get(id_field):
+                yield task_id
+
 
 class NotionTaskRepository(ExtendedRepository):
 
     class Meta:
         model = NotionTask
         collection = "notion-task"
+        indexes = [Index(fields=["notion_id"], unique=True)]
 
 
 class GoogleTaskRepository(ExtendedRepository):
@@ -64,3 +111,328 @@ class GoogleTaskRepository(ExtendedRepository):
     class Meta:
         model = GoogleTask
         collection = "google-task"
+        indexes = [Index(fields=["google_id"], unique=True)]
+
+
+class Tenant(MongoDBModel):
+    tenant_id: str
+    # Notion
+    notion_secret: str
+    notion_task_db: str
+    notion_bucket_db: str
+    # Google, the token is the content of a token.json
+    google_token: dict
+    google_default_tasklist: str | None = None
+    # Mapper
+    status_mapper: list
+    # The database holding the internal tasks of this tenant
+    mongo_db: str | None = None
+
+
+class TenantRepository(ExtendedRepository):
+
+    class Meta:
+        model = Tenant
+        collection = "tenant"
+        indexes = [Index(fields=["tenant_id"], unique=True)]
+
+
+class Lease(MongoDBModel):
+    resource: str
+    owner: str
+    # Fencing token, incremented every time the lease changes owner
+    token: int
+    expires: datetime
+
+
+class LeaseLostError(Exception):
+    pass
+
+
+class LeaseRepository(ExtendedRepository):
+
+    class Meta:
+        model = Lease
+        collection = "lease"
+
+    @classmethod
+    def _get_collection(cls):
+        """Leases are shared by all tenants, so they always live in the main
+        database"""
+        collection = MongomanticClient.client[settings.mongo_db][cls.Meta.collection]
+        if not getattr(cls, "_indexes", None):
+            collection.create_index("resource", unique=True)
+            cls._indexes = True
+        return collection
+
+    @classmethod
+    def acquire(cls, resource: str, owner: str, ttl: int) -> Lease | None:
+        """Acquires the lease of a resource if it's free or expired.
+
+        Returns:
+            [Lease | None]: The acquired lease, None if another owner holds it
+        """
+        now = datetime.utcnow()
+        try:
+            document = cls._get_collection().find_one_and_update(
+                {"resource": resource, "expires": {"$lte": now}},
+                {
+                    "$set": {"owner": owner, "expires": now + timedelta(seconds=ttl)},
+                    "$inc": {"token": 1}
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # The lease exists and has not expired
+            return None
+
+        return Lease.from_mongo(document)
+
+    @classmethod
+    def renew(cls, lease: Lease, ttl: int) -> bool:
+        """Extends a held lease. Returns False if the lease has been lost"""
+        now = datetime.utcnow()
+        res = cls._get_collection().update_one(
+            {"resource": lease.resource, "owner": lease.owner, "token": lease.token, "expires": {"$gte": now}},
+            {"$set": {"expires": now + timedelta(seconds=ttl)}}
+        )
+        return res.matched_count == 1
+
+    @classmethod
+    def holds(cls, lease: Lease) -> bool:
+        """Checks that the lease is still held with the same fencing token"""
+        return cls._get_collection().count_documents({
+            "resource": lease.resource,
+            "owner": lease.owner,
+            "token": lease.token,
+            "expires": {"$gte": datetime.utcnow()}
+        }) == 1
+
+    @classmethod
+    def release(cls, lease: Lease):
+        """Releases a held lease by letting it expire now"""
+        cls._get_collection().update_one(
+            {"resource": lease.resource, "owner": lease.owner, "token": lease.token},
+            {"$set": {"expires": datetime.utcnow()}}
+        )
+
+
+class Checkpoint(MongoDBModel):
+    # The job the checkpoint belongs to, e.g. "backfill"
+    name: str
+    phase: str
+    done: int = 0
+    total: int = 0
+    updated: datetime
+
+
+class CheckpointRepository(ExtendedRepository):
+
+    class Meta:
+        model = Checkpoint
+        collection = "checkpoint"
+        indexes = [Index(fields=["name"], unique=True)]
+
+
+class Tombstone(MongoDBModel):
+    # A task missing from the listing of a provider, deleted on the other
+    # provider and internally once it's still missing after the grace window
+    provider: str
+    task_id: str
+    first_missing: datetime
+    # Set once the task is found missing again after the grace window
+    confirmed: bool = False
+    attempts: int = 0
+
+
+class TombstoneRepository(ExtendedRepository):
+
+    class Meta:
+        model = Tombstone
+        collection = "tombstone"
+        indexes = [Index(fields=["provider", "task_id"], unique=True)]
+
+
+class OutboxEntry(MongoDBModel):
+    # Entries are deduplicated on the key, a newer write of the same task
+    # replaces the older one
+    key: str
+    provider: str
+    # The task to write to the provider and the internal task of the other
+    # provider that is linked to it
+    task: dict
+    linked: dict | None = None
+    # The fields to write, None writes all of them
+    fields: List[str] | None = None
+    # The task returned by the provider, set as soon as the provider write
+    # has succeeded
+    result: dict | None = None
+    attempts: int = 0
+    created: datetime
+
+
+class OutboxRepository(ExtendedRepository):
+
+    class Meta:
+        model = OutboxEntry
+        collection = "outbox"
+        indexes = [Index(fields=["key"], unique=True)]
+
+
+class Outbox:
+    """Provider writes go through the outbox. A write is stored in MongoDB
+    before it is sent to the provider, and the provider's response is stored
+    before the internal tasks are updated. An entry left behind by a crash is
+    replayed by `drain` without writing to the provider again if the provider
+    write already went through, so no duplicate tasks are created.
+    """
+
+    providers = {
+        "google": (GoogleTask, GoogleTaskRepository, "google_id", "google_save"),
+        "notion": (NotionTask, NotionTaskRepository, "notion_id", "notion_save"),
+    }
+
+    # The lease the writes are fenced with, if any. A provider write is only
+    # sent while the lease is still held with the same fencing token.
+    lease: Lease | None = None
+
+    @classmethod
+    def check_lease(cls):
+        """Raises LeaseLostError if the lease the writes are fenced with has
+        been lost"""
+        if cls.lease and not LeaseRepository.holds(cls.lease):
+            raise LeaseLostError(f"The lease of {cls.lease.resource} has been lost")
+
+    @classmethod
+    def write(cls, provider: str, task, linked=None, fields: List[str] = None) -> Tuple:
+        """Saves the task to the provider and saves it internally together with
+        the linked internal task of the other provider.
+
+        Args:
+            provider (str): "google" or "notion"
+            task (GoogleTask | NotionTask): The task to save to the provider
+            linked (NotionTask | GoogleTask, optional): The internal task of
+                the other provider. It gets the id of the saved task.
+            fields (List[str], optional): Only write these fields of an
+                existing task. Defaults to all fields.
+
+        Returns:
+            [Tuple]: The saved task and the saved linked task
+        """
+        _, _, id_field, _ = cls.providers[provider]
+
+        if task_id := getattr(task, id_field):
+            key = f"{provider}:{task_id}"
+        else:
+            # New task, it can only be identified through the linked task
+            linked_id_field = "notion_id" if provider == "google" else "google_id"
+            key = f"{provider}:{linked_id_field}={getattr(linked, linked_id_field)}"
+
+        entry = OutboxRepository._get_collection().find_one_and_update(
+            {"key": key},
+            {
+                "$set": {
+                    "provider": provider,
+                    "task": task.dict(exclude={"id"}),
+                    "linked": linked.dict(exclude={"id"}) if linked else None,
+                    "fields": fields,
+                    "result": None,
+                    "attempts": 0,
+                    "created": datetime.now(),
+                }
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+
+        return cls.replay(OutboxEntry.from_mongo(entry))
+
+    @classmethod
+    def replay(cls, entry: OutboxEntry) -> Tuple:
+        """Performs the writes of an outbox entry. Replaying an entry more than
+        once has the same effect as replaying it once.
+
+        Returns:
+            [Tuple]: The saved task and the saved linked task
+        """
+        model, repository, id_field, save_method = cls.providers[entry.provider]
+        collection = OutboxRepository._get_collection()
+
+        try:
+            if entry.result is None:
+                cls.check_lease()
+                saved_task = getattr(model.from_dict(entry.task), save_method)(fields=entry.fields)
+                entry.result = saved_task.dict(exclude={"id"})
+                collection.update_one({"_id": entry.id}, {"$set": {"result": entry.result}})
+            else:
+                saved_task = model.from_dict(entry.result)
+        except GoogleConflictError:
+            # The task has changed since it was read, the write is dropped and
+            # the task is merged again in the next cycle
+            collection.delete_one({"_id": entry.id})
+            raise
+        except Exception:
+            collection.update_one({"_id": entry.id}, {"$inc": {"attempts": 1}})
+            raise
+
+        saved_linked = None
+        if entry.linked:
+            linked_model, linked_repository, linked_id_field, _ = cls.providers[
+                "notion" if entry.provider == "google" else "google"]
+            linked = linked_model.from_dict(entry.linked)
+            setattr(linked, id_field, getattr(saved_task, id_field))
+            saved_linked = linked_repository.upsert(linked, linked_id_field)
+
+        saved_task = repository.upsert(saved_task, id_field)
+        collection.delete_one({"_id": entry.id})
+        return saved_task, saved_linked
+
+    @classmethod
+    def drain(cls):
+        """Replays the entries left in the outbox, for example by a crash in
+        the middle of a sync or by a failing provider write. Entries that keep
+        failing and writes of tasks that have changed since are dropped, the
+        tasks are merged again in the next cycle instead.
+
+        Raises:
+            LeaseLostError: If the lease the writes are fenced with is lost
+        """
+        collection = OutboxRepository._get_collection()
+        for entry in OutboxRepository.find():
+            if entry.result is None and (reason := cls.stale(entry)):
+                settings.logger.warning(f"Dropping outbox entry {entry.key}, {reason}")
+                collection.delete_one({"_id": entry.id})
+                continue
+
+            try:
+                cls.replay(entry)
+            except LeaseLostError:
+                raise
+            except Exception as e:
+                settings.logger.error(f"Could not replay outbox entry {entry.key} (attempt {entry.attempts + 1}): {e}")
+
+    @classmethod
+    def stale(cls, entry: OutboxEntry) -> str | None:
+        """The reason an entry that has not been written to the provider yet
+        must not be replayed anymore, if any"""
+        if entry.attempts >= settings.outbox_max_attempts:
+            return f"it failed {entry.attempts} times"
+
+        _, repository, id_field, _ = cls.providers[entry.provider]
+        if not (task_id := entry.task.get(id_field)):
+            return None
+        i_task = next(repository.find(**{id_field: task_id}), None)
+        updated = getattr(i_task, "updated", None)
+        if updated is None:
+            return None
+        if not isinstance(updated, datetime):
+            updated = updated.datetime()
+        # The entries are created in local time, the providers' timestamps
+        # are in UTC
+        created = entry.created.astimezone(timezone.utc)
+        if updated.tzinfo is None:
+            updated = updated.replace(tzinfo=timezone.utc)
+        if updated > created:
+            return "the task has changed since it was written"
+        return None
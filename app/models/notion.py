@@ -1,16 +1,158 @@
-from typing import List, Type
+import httpx
+import hashlib
+from functools import lru_cache
+from typing import List, Tuple, Type
+from httpx import Response
 from mongomantic import MongoDBModel
 from notion_client import Client as NotionClient
 from notion_client.errors import APIResponseError
+from notion_client.helpers import pick
 from datetime import date, time, datetime
 
 from app.config import settings
+from app.ratelimit import RateLimiter
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+
+# Shared by all Notion clients of this process
+notion_rate_limiter = RateLimiter(settings.notion_rate_limit)
+
+
+class FastNotionClient(NotionClient):
+    """Notion client decoding successful responses straight from the raw
+    response bytes, using orjson when it is installed. Requests are rate
+    limited per process.
+    """
+
+    def request(self, *args, **kwargs):
+        notion_rate_limiter.acquire()
+        return super().request(*args, **kwargs)
+
+    def _parse_response(self, response: Response):
+        if response.is_success:
+            return json_loads(response.content)
+        return super()._parse_response(response)
+
+
+def create_notion_client(http_client: httpx.Client = None) -> FastNotionClient:
+    """Creates a Notion client. Unless a httpx client is given, the client
+    gets a pooled httpx client using the limits and timeouts in settings.
+
+    Args:
+        http_client (httpx.Client, optional): A httpx client to send the
+            requests with, for example one with a mock transport in tests.
+    """
+    if http_client is None:
+        http2 = settings.notion_http2
+        if http2:
+            try:
+                import h2
+            except ImportError:
+                settings.logger.warning("The h2 package is missing, using HTTP/1.1 for Notion")
+                http2 = False
+
+        http_client = httpx.Client(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=settings.notion_max_connections,
+                max_keepalive_connections=settings.notion_max_keepalive
+            )
+        )
+
+    client = FastNotionClient(auth=settings.notion_secret, client=http_client)
+    # The Notion client only supports one timeout for everything, so the
+    # tuned timeout is set on the httpx client afterwards
+    client.client.timeout = httpx.Timeout(
+        settings.notion_timeout, connect=settings.notion_connect_timeout)
+    return client
+
+
+def use_notion_client(client: FastNotionClient):
+    """Replaces the shared Notion client used by all the Notion models"""
+    global notion_client
+    notion_client = client
+
+
+def query_database(database_id: str, filter_properties: List[str] = None, **kwargs) -> dict:
+    """Queries a Notion database. Unlike `databases.query` of the Notion
+    client, `filter_properties` is supported, limiting the properties in the
+    response to the given property ids.
+    """
+    return notion_client.request(
+        path=f"databases/{database_id}/query",
+        method="POST",
+        query={"filter_properties": filter_properties} if filter_properties else None,
+        body=pick(kwargs, "filter", "sorts", "start_cursor", "page_size")
+    )
+
+
+@lru_cache(maxsize=None)
+def notion_property_ids(database_id: str, property_names: Tuple[str]) -> List[str]:
+    """Returns the ids of the given properties of a Notion database. Property
+    ids never change, so they are only looked up once per database."""
+    db_res = notion_client.databases.retrieve(database_id)
+    return [db_res["properties"][name]["id"] for name in property_names]
+
+
+# Notion rejects text objects longer than this, and rich text arrays with
+# more than RICH_TEXT_MAX_ITEMS text objects
+RICH_TEXT_MAX_LENGTH = 2000
+RICH_TEXT_MAX_ITEMS = 100
+
+
+def to_rich_text(text: str) -> List[dict]:
+    """Splits a text into the text objects of a Notion rich text array"""
+    if len(text) > RICH_TEXT_MAX_LENGTH * RICH_TEXT_MAX_ITEMS:
+        settings.logger.warning("Text is too long for Notion, it will be truncated")
+
+    return [
+        {
+            "type": "text",
+            "text": {
+                "content": text[start:start + RICH_TEXT_MAX_LENGTH]
+            }
+        }
+        for start in range(0, min(len(text), RICH_TEXT_MAX_LENGTH * RICH_TEXT_MAX_ITEMS), RICH_TEXT_MAX_LENGTH)
+    ]
+
+
+def text_hash(text: str | None) -> str | None:
+    """Hash used to tell whether a text has changed"""
+    if text:
+        return hashlib.sha1(text.encode()).hexdigest()
+
+
+def use_notion_databases(task_db: str, bucket_db: str):
+    """Points the Notion models to another task and bucket database"""
+    global notion_tasks_db_id
+    notion_tasks_db_id = task_db
+    NotionTasks.Meta.database_id = task_db
+    NotionBuckets.Meta.database_id = bucket_db
+
 
-# Setup Notion connection
-notion_client = NotionClient(auth=settings.notion_secret)
+# Setup Notion connection. The client is thread-safe and shared by all models
+# so its connections are reused.
+notion_client = create_notion_client()
 notion_tasks_db_id = settings.notion_task_db
 
 
+@lru_cache(maxsize=8192)
+def parse_notion_timestamp(date_str: str) -> Tuple[datetime, bool]:
+    """Parses a Notion date or datetime string. The same timestamps show up
+    over and over again between cycles, so the results are cached.
+
+    Returns:
+        [Tuple[datetime, bool]]: The parsed datetime and whether it has a time
+    """
+    if "T" in date_str:
+        return datetime.fromisoformat(date_str), True
+    return datetime.combine(date.fromisoformat(date_str), time(second=0)), False
+
+
 class NotionBaseModel(MongoDBModel):
 
     class Config:
@@ -144,7 +286,11 @@ class NotionDatabaseModel(NotionBaseModel):
         return cls.from_notion(db_res)
 
     def list(self, **kwargs):
-        db_res = notion_client.databases.query(self.Meta.database_id, **kwargs)
+        """Returns a generator of the entries in the database. The filters,
+        sorts, page size and properties given are used for every page.
+        """
+        kwargs.setdefault("page_size", 100)
+        db_res = query_database(self.Meta.database_id, **kwargs)
         while True:
             for task in db_res["results"]:
                 try:
@@ -156,9 +302,10 @@ class NotionDatabaseModel(NotionBaseModel):
                     pass
 
             if db_res["has_more"]:
-                db_res = notion_client.databases.query(
+                db_res = query_database(
                     self.Meta.database_id,
-                    next_cursor=db_res["next_cursor"]
+                    start_cursor=db_res["next_cursor"],
+                    **kwargs
                 )
             else:
                 break
@@ -188,14 +335,8 @@ class NotionTime(NotionBaseModel):
 
     @classmethod
     def from_notion(cls, date_str: str):
-        if len(tmp := date_str.split("T")) > 1:
-            date_str, time_str = tmp
-            dt = datetime.combine(
-                date.fromisoformat(date_str),
-                time.fromisoformat(time_str)
-            )
-            return cls(dt=dt)
-        return cls.from_date(d=date.fromisoformat(date_str))
+        dt, has_time = parse_notion_timestamp(date_str)
+        return cls(dt=dt, has_time=has_time)
 
     def to_notion(self):
         if self.has_time:
@@ -256,6 +397,8 @@ class NotionTask(NotionBaseModel):
     parent_task_ids: List[str] = []
     due: NotionTime | None = None
     updated: NotionTime | None = None
+    # Hash of the notes as they are on Notion, used to only upload changed notes
+    notes_hash: str | None = None
 
     # Metafields
     database_id: str
@@ -264,6 +407,23 @@ class NotionTask(NotionBaseModel):
 
     class Meta:
         internal_fields = ["database_id", "synced", "google_id", "id"]
+        # The fields read from Notion and the properties they are stored in
+        notion_properties = {
+            "title": "Task",
+            "notes": "Notes",
+            "status": "Status",
+            "labels": "Labels",
+            "bucket_id": "Bucket",
+            "due": "Due",
+            "subtask_ids": "Subtasks",
+            "parent_task_ids": "Parent task",
+        }
+        # The fields edited by users, the subtasks follow the parent relation
+        # of the subtasks
+        content_fields = [
+            "title", "notes", "status", "labels", "bucket_id", "due",
+            "parent_task_ids"
+        ]
 
 
     @classmethod
@@ -271,36 +431,30 @@ class NotionTask(NotionBaseModel):
         """Converts the response from Notion to a dict that can be passed to a
         NotionTask as keyword arguments
         """
+        properties = response["properties"]
+
         bucket_id = None
-        if tmp := response["properties"]["Bucket"]["relation"]:
+        if tmp := properties["Bucket"]["relation"]:
             bucket_id = tmp[0]["id"]
 
-        notes = None
-        if tmp := response["properties"]["Notes"]["rich_text"]:
-            notes = tmp[0]["plain_text"]
+        # Long notes are split over several text objects
+        notes = "".join(text["plain_text"] for text in properties["Notes"]["rich_text"]) or None
 
         due = None
-        if tmp := response["properties"]["Due"]["date"]:
-            date_str = tmp["start"]
-            due = NotionTime.from_notion(date_str)
+        if tmp := properties["Due"]["date"]:
+            due = NotionTime.from_notion(tmp["start"])
 
-        subtask_ids = []
-        if tmp := response["properties"]["Subtasks"]["relation"]:
-            for task_id in tmp:
-                subtask_ids.append(task_id["id"])
-
-        parent_task_ids = []
-        if tmp := response["properties"]["Parent task"]["relation"]:
-            for task_id in tmp:
-                parent_task_ids.append(task_id["id"])
+        subtask_ids = [task_id["id"] for task_id in properties["Subtasks"]["relation"]]
+        parent_task_ids = [task_id["id"] for task_id in properties["Parent task"]["relation"]]
 
         params = {
             "notion_id": response["id"],
-            "title": response["properties"]["Task"]["title"][0]["plain_text"],
-            "status": NotionStatus.from_notion(response["properties"]["Status"]["select"]),
-            "labels": NotionLabel.from_notion(response["properties"]["Labels"]["multi_select"]),
+            "title": properties["Task"]["title"][0]["plain_text"],
+            "status": NotionStatus.from_notion(properties["Status"]["select"]),
+            "labels": NotionLabel.from_notion(properties["Labels"]["multi_select"]),
             "bucket_id": bucket_id,
             "notes": notes,
+            "notes_hash": text_hash(notes),
             "subtask_ids": subtask_ids,
             "parent_task_ids": parent_task_ids,
             "due": due,
@@ -337,12 +491,7 @@ class NotionTask(NotionBaseModel):
 
         content = []
         if self.notes:
-            content = [{
-                "type": "text",
-                "text": {
-                    "content": self.notes
-                }
-            }]
+            content = to_rich_text(self.notes)
 
         due = None
         if self.due:
@@ -379,15 +528,30 @@ class NotionTask(NotionBaseModel):
 
         return kwargs
 
-    def notion_save(self):
+    def notion_save(self, fields: List[str] = None):
         """Saves the task to Notion
 
+        Args:
+            fields (List[str], optional): Only update the properties of these
+                fields. Defaults to all fields.
+
         Returns:
             [NotionTask]: A new instance of the NotionTask
         """
         if self.notion_id:
-            notion_res = notion_client.pages.update(
-                self.notion_id, **self.to_notion_kwargs())
+            if fields is not None and not fields:
+                return self
+            kwargs = self.to_notion_kwargs()
+            if fields is not None:
+                properties = [self.Meta.notion_properties[field] for field in fields]
+                kwargs = {"properties": {
+                    name: value for name, value in kwargs["properties"].items()
+                    if name in properties
+                }}
+            if "Notes" in kwargs["properties"] and self.notes_hash and self.notes_hash == text_hash(self.notes):
+                # The notes on Notion are already up to date
+                del kwargs["properties"]["Notes"]
+            notion_res = notion_client.pages.update(self.notion_id, **kwargs)
         else:
             notion_res = notion_client.pages.create(**self.to_notion_kwargs())
 
@@ -400,6 +564,14 @@ class NotionTask(NotionBaseModel):
         updated_task = NotionTask.from_dict(new_params)
         return updated_task
 
+    def changed_fields(self, other, fields: List[str] = None) -> List[str]:
+        """Returns the fields that differ from the other task. Defaults to the
+        fields stored in Notion properties.
+        """
+        fields = fields or list(self.Meta.notion_properties)
+        params, other_params = self.dict(include=set(fields)), other.dict(include=set(fields))
+        return [field for field in fields if params[field] != other_params[field]]
+
     def notion_delete(self):
         """Deletes the task in Notion"""
         return notion_client.blocks.delete(self.notion_id)
@@ -430,6 +602,26 @@ class NotionTasks(NotionDatabaseModel):
     def __init__(self):
         return
 
+    def list_syncable(self, **kwargs):
+        """Returns a generator of the tasks that can be synced to Google, the
+        ones in a bucket and with a status. Only the properties of NotionTask
+        are fetched.
+        """
+        syncable_filter = {"and": [
+            {"property": "Bucket", "relation": {"is_not_empty": True}},
+            {"property": "Status", "select": {"is_not_empty": True}},
+        ]}
+        if task_filter := kwargs.pop("filter", None):
+            syncable_filter["and"].append(task_filter)
+
+        return self.list(
+            filter=syncable_filter,
+            filter_properties=notion_property_ids(
+                self.Meta.database_id,
+                tuple(self.Meta.model.Meta.notion_properties.values())),
+            **kwargs
+        )
+
     @classmethod
     def get(cls, id: str, **kwargs):
         page_res = notion_client.pages.retrieve(id, **kwargs)
@@ -437,6 +629,34 @@ class NotionTasks(NotionDatabaseModel):
         assert page_res["parent"]["database_id"] == cls.Meta.database_id
         return cls.Meta.model.from_notion(page_res)
 
+    def list_unsyncable_ids(self, **kwargs):
+        """Returns a generator of the ids of the tasks left out of
+        `list_syncable`, the ones without a bucket or a status, and the ones
+        matching the given filter. Only the title of the tasks is fetched.
+        """
+        unsyncable_filter = {"or": [
+            {"property": "Bucket", "relation": {"is_empty": True}},
+            {"property": "Status", "select": {"is_empty": True}},
+        ]}
+        if task_filter := kwargs.pop("filter", None):
+            unsyncable_filter["or"].append(task_filter)
+
+        kwargs.setdefault("page_size", 100)
+        filter_properties = notion_property_ids(
+            self.Meta.database_id, (self.Meta.model.Meta.notion_properties["title"],))
+        db_res = query_database(
+            self.Meta.database_id, filter=unsyncable_filter, filter_properties=filter_properties, **kwargs)
+        while True:
+            for task in db_res["results"]:
+                yield task["id"]
+
+            if not db_res["has_more"]:
+                break
+            db_res = query_database(
+                self.Meta.database_id, filter=unsyncable_filter, filter_properties=filter_properties,
+                start_cursor=db_res["next_cursor"], **kwargs)
+
+
 class NotionBuckets(NotionDatabaseModel):
     class Meta:
         model = NotionBucket
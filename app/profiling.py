@@ -0,0 +1,62 @@
+import cProfile
+import io
+import os
+import pstats
+from contextlib import contextmanager
+from datetime import datetime
+
+from app.config import settings
+
+logger = settings.logger
+
+# Functions listed in the summary of a profiled cycle
+SUMMARY_SIZE = 20
+
+
+class CycleProfiler:
+    """Profiles the next sync cycles with cProfile. Every profiled cycle is
+    written to a .pstats file, which snakeviz, gprof2dot or speedscope can
+    open, and a summary of the functions taking the most time is logged.
+    """
+
+    cycles: int
+    directory: str
+
+    def __init__(self, cycles: int = None, directory: str = None) -> None:
+        self.cycles = settings.profile_cycles if cycles is None else cycles
+        self.directory = directory or settings.profile_dir
+        self.profiled = 0
+
+    @contextmanager
+    def cycle(self):
+        """Profiles the wrapped cycle, unless enough cycles have been profiled"""
+        if self.profiled >= self.cycles:
+            yield
+            return
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self.profiled += 1
+            self.write(profiler)
+
+    def write(self, profiler: cProfile.Profile) -> str:
+        """Writes the profile of a cycle and logs its summary
+
+        Returns:
+            [str]: The path of the .pstats file
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(
+            self.directory, f"cycle-{datetime.now():%Y%m%d-%H%M%S}-{self.profiled}.pstats")
+        profiler.dump_stats(path)
+
+        summary = io.StringIO()
+        stats = pstats.Stats(profiler, stream=summary)
+        stats.strip_dirs().sort_stats(pstats.SortKey.TIME).print_stats(SUMMARY_SIZE)
+        logger.info(f"Profile of cycle {self.profiled}/{self.cycles} written to {path}")
+        logger.info(summary.getvalue())
+        return path
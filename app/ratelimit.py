@@ -0,0 +1,39 @@
+import threading
+from time import monotonic, sleep
+
+
+class RateLimiter:
+    """A token bucket limiting the request rate of the current process. Every
+    worker process has its own buckets and therefore its own budget.
+    """
+
+    rate: float
+    burst: float
+
+    def __init__(self, rate: float, burst: float = None) -> None:
+        """
+        Args:
+            rate (float): Requests per second, 0 disables the limit
+            burst (float, optional): Requests that can be sent back to back.
+                Defaults to `rate`.
+        """
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self._tokens = self.burst
+        self._last = monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request may be sent"""
+        if not self.rate:
+            return
+
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if wait:
+            sleep(wait)
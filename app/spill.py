@@ -0,0 +1,195 @@
+import os
+import pickle
+import sqlite3
+import sys
+import tempfile
+import threading
+
+from app.config import settings
+
+logger = settings.logger
+
+# Estimated bytes taken by an entry of a set or dict, besides its content
+ENTRY_OVERHEAD = 64
+
+_usage_lock = threading.Lock()
+# Estimated bytes held in memory by all the spillable structures
+_usage = 0
+
+
+def _reserve(size: int) -> bool:
+    """Accounts for memory taken by a structure. Returns False if that exceeds
+    the memory budget."""
+    global _usage
+    with _usage_lock:
+        _usage += size
+        return not settings.memory_budget or _usage <= settings.memory_budget * 1024 * 1024
+
+
+def _release(size: int):
+    global _usage
+    with _usage_lock:
+        _usage -= size
+
+
+class Spillable:
+    """Base of the structures kept in memory until the memory budget is
+    exceeded, and in a temporary sqlite database after that. The keys and
+    values are pickled on disk.
+    """
+
+    def __init__(self) -> None:
+        self._size = 0
+        self._db: sqlite3.Connection | None = None
+        self._path = None
+
+    @property
+    def spilled(self) -> bool:
+        return self._db is not None
+
+    def _grow(self, size: int):
+        self._size += size
+        if not _reserve(size):
+            self._spill()
+
+    def _spill(self):
+        fd, self._path = tempfile.mkstemp(prefix="tasksyncer-", suffix=".sqlite")
+        os.close(fd)
+        self._db = sqlite3.connect(self._path)
+        self._db.execute("CREATE TABLE entries (key BLOB PRIMARY KEY, value BLOB) WITHOUT ROWID")
+        self._db.executemany(
+            "INSERT INTO entries VALUES (?, ?)",
+            ((pickle.dumps(key), pickle.dumps(value)) for key, value in self._memory_items()))
+        self._clear_memory()
+        logger.info(f"Memory budget exceeded, {type(self).__name__} spilled to {self._path}")
+
+    def _memory_items(self):
+        raise NotImplementedError
+
+    def _clear_memory(self):
+        raise NotImplementedError
+
+    def _disk_contains(self, key) -> bool:
+        return self._db.execute(
+            "SELECT 1 FROM entries WHERE key = ?", (pickle.dumps(key),)).fetchone() is not None
+
+    def _disk_keys(self):
+        for (key,) in self._db.execute("SELECT key FROM entries"):
+            yield pickle.loads(key)
+
+    def __len__(self) -> int:
+        if self._db:
+            return self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return len(self._memory)
+
+    def close(self):
+        """Releases the memory and removes the database of the structure"""
+        self._clear_memory()
+        if self._db:
+            self._db.close()
+            os.remove(self._path)
+            self._db = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class SpillSet(Spillable):
+    """A set, e.g. of task ids, that spills to disk above the memory budget"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._memory = set()
+
+    def _memory_items(self):
+        return ((key, None) for key in self._memory)
+
+    def _clear_memory(self):
+        _release(self._size)
+        self._size = 0
+        self._memory = set()
+
+    def add(self, key):
+        if self._db:
+            self._db.execute("INSERT OR IGNORE INTO entries VALUES (?, NULL)", (pickle.dumps(key),))
+        elif key not in self._memory:
+            self._memory.add(key)
+            self._grow(sys.getsizeof(key) + ENTRY_OVERHEAD)
+
+    def discard(self, key):
+        if self._db:
+            self._db.execute("DELETE FROM entries WHERE key = ?", (pickle.dumps(key),))
+        else:
+            self._memory.discard(key)
+
+    def __contains__(self, key) -> bool:
+        if self._db:
+            return self._disk_contains(key)
+        return key in self._memory
+
+    def __iter__(self):
+        if self._db:
+            return self._disk_keys()
+        return iter(list(self._memory))
+
+
+class SpillDict(Spillable):
+    """A dict, e.g. of pending writes, that spills to disk above the memory
+    budget. Values are copies once spilled, a changed value has to be set
+    again.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._memory = {}
+        self._sizes = {}
+
+    def _memory_items(self):
+        return self._memory.items()
+
+    def _clear_memory(self):
+        _release(self._size)
+        self._size = 0
+        self._memory = {}
+        self._sizes = {}
+
+    def __setitem__(self, key, value):
+        if self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?)", (pickle.dumps(key), pickle.dumps(value)))
+            return
+
+        self._memory[key] = value
+        if settings.memory_budget:
+            # Only measured when there is a budget to enforce
+            size = len(pickle.dumps(value)) + sys.getsizeof(key) + ENTRY_OVERHEAD
+            self._grow(size - self._sizes.get(key, 0))
+            if not self._db:
+                self._sizes[key] = size
+
+    def get(self, key, default=None):
+        if self._db:
+            row = self._db.execute(
+                "SELECT value FROM entries WHERE key = ?", (pickle.dumps(key),)).fetchone()
+            return pickle.loads(row[0]) if row else default
+        return self._memory.get(key, default)
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return self.get(key)
+
+    def __contains__(self, key) -> bool:
+        if self._db:
+            return self._disk_contains(key)
+        return key in self._memory
+
+    def items(self):
+        if self._db:
+            for key, value in self._db.execute("SELECT key, value FROM entries"):
+                yield pickle.loads(key), pickle.loads(value)
+        else:
+            yield from list(self._memory.items())
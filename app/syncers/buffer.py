@@ -0,0 +1,96 @@
+from typing import List
+
+from app.models.mongo import LeaseLostError, Outbox
+from app.spill import SpillDict, SpillSet
+from app.config import settings
+
+logger = settings.logger
+
+
+class WriteBuffer:
+    """Collects the writes to existing tasks during a sync cycle, keyed by
+    the provider and the external id of the task. Writes of the same task are
+    merged, so when the buffer is flushed every task is written to the
+    provider and to MongoDB at most once.
+
+    The pending writes spill to disk above the memory budget.
+    """
+
+    writes: SpillDict
+    refreshes: SpillSet
+
+    def __init__(self) -> None:
+        self.writes = SpillDict()
+        self.refreshes = SpillSet()
+
+    def write(self, provider: str, task, linked=None, fields: List[str] = None):
+        """Buffers a provider write of an existing task.
+
+        Args:
+            provider (str): "google" or "notion"
+            task (GoogleTask | NotionTask): The task to save to the provider
+            linked (NotionTask | GoogleTask, optional): The internal task of
+                the other provider
+            fields (List[str], optional): The fields changed by this write. If
+                the task already has a pending write only these fields are
+                merged into it. Defaults to all fields.
+        """
+        _, _, id_field, _ = Outbox.providers[provider]
+        key = (provider, getattr(task, id_field))
+
+        if pending := self.writes.get(key):
+            if fields:
+                changes = task.dict(include=set(fields))
+            else:
+                changes = task.dict(exclude={"id"})
+            pending["task"] = pending["task"].update_from_params(changes)
+            if linked:
+                pending["linked"] = linked
+            if fields is None or pending["fields"] is None:
+                pending["fields"] = None
+            else:
+                pending["fields"] = [*pending["fields"], *(
+                    field for field in fields if field not in pending["fields"])]
+            # A spilled write is a copy, it has to be stored again
+            self.writes[key] = pending
+        else:
+            self.writes[key] = {"task": task, "linked": linked, "fields": fields}
+
+        # The provider write returns the up to date task, no need to refresh it
+        self.refreshes.discard(key)
+
+    def refresh(self, provider: str, task_id: str):
+        """Buffers a refresh of an internal task from the provider"""
+        key = (provider, task_id)
+        if key not in self.writes:
+            self.refreshes.add(key)
+
+    def flush(self):
+        """Sends the buffered writes and refreshes and empties the buffer.
+
+        Raises:
+            LeaseLostError: If the lease the writes are fenced with is lost,
+                the remaining writes are dropped
+        """
+        try:
+            for (provider, task_id), pending in self.writes.items():
+                try:
+                    Outbox.write(provider, pending["task"], linked=pending["linked"], fields=pending["fields"])
+                except LeaseLostError:
+                    raise
+                except Exception as e:
+                    # The write is left in the outbox and replayed later
+                    logger.error("Could not write task to %s (%s): %s", provider, task_id, e)
+
+            for provider, task_id in self.refreshes:
+                model, repository, id_field, _ = Outbox.providers[provider]
+                try:
+                    i_task = next(repository.find(**{id_field: task_id}))
+                    repository.upsert(i_task.fetch(), id_field)
+                except Exception as e:
+                    logger.error("Could not refresh internal task from %s (%s): %s", provider, task_id, e)
+        finally:
+            self.writes.close()
+            self.refreshes.close()
+            self.writes = SpillDict()
+            self.refreshes = SpillSet()
@@ -1,27 +1,57 @@
 
 
 from datetime import datetime
-from typing import List
+from collections import Counter
+from itertools import chain
+from typing import Dict, List
 
 from app.models.google import GoogleTask, GoogleTasks
 from app.models.notion import NotionTask
-from app.models.mongo import GoogleTaskRepository, NotionTaskRepository
+from app.models.mongo import GoogleTaskRepository, NotionTaskRepository, Outbox
+from app.syncers.buffer import WriteBuffer
+from app.syncers.merge import merge_tasks
+from app.syncers.snapshot import Snapshot
+from app.syncers.plan import Plan
+from app.syncers.priority import Budget, WorkQueue
+from app.syncers.tombstones import Tombstones
+from app.spill import SpillSet
 from app.converters import google_to_notion_task
 from app.config import settings
 
 logger = settings.logger
+task_logger = settings.task_logger
+
+
+def list_google_tasks(tasklists: List[str] = None):
+    """Lists the tasks of all tasklists, or only of the given tasklists"""
+    if tasklists is None:
+        return GoogleTasks.list()
+    return chain.from_iterable(
+        GoogleTasks.list(tasklist_id=tasklist_id) for tasklist_id in tasklists)
+
+
+def tasklist_scope(tasklists: List[str] = None) -> dict:
+    """The MongoDB filter of the internal tasks in the given tasklists"""
+    return {} if tasklists is None else {"tasklist": {"$in": tasklists}}
+
 
 class GoogleSyncer:
 
     last_sync: datetime
-    synced_tasks: List[GoogleTask]
+    # Start of the last cycle that synced every listed task, or of the
+    # first cycle, by tasklist. None stands for the cycles of all tasklists.
+    edited_since: Dict[str | None, datetime]
+    synced_task_ids: SpillSet
+    buffer: WriteBuffer
 
     def __init__(self) -> None:
         self.last_sync = None
-        self.synced_tasks = []
+        self.edited_since = {}
+        self.synced_task_ids = SpillSet()
+        self.buffer = WriteBuffer()
 
     def sync_task(self, g_task: GoogleTask, fix_parent=True, sync_notion=True) -> GoogleTask:
-        logger.debug(f'Syncing task "{g_task.title}"')
+        task_logger.debug('Syncing task "%s"', g_task.title, extra={"google_id": g_task.google_id})
 
         try:
             # Check if the task exists internally
@@ -30,40 +60,43 @@ class GoogleSyncer:
             if g_task.updated > i_task.updated:
                 # The Google task is newer, update internal tasks
                 # Should trigger an update at Notion as well
-                logger.debug("--> Updating task from Google")
-                i_task = i_task.fetch()
-                i_task.synced = datetime.now()
-                
-                if sync_notion:
-                    old_i_notion_task: NotionTask = next(NotionTaskRepository.find(notion_id=i_task.notion_id))
-
-                    i_notion_task = old_i_notion_task.update_from_params(
-                        google_to_notion_task(i_task).dict(
-                            exclude={*NotionTask.Meta.internal_fields, "updated", "subtask_ids"}
-                        )
-                    )
-
-                    i_notion_task = i_notion_task.notion_save()
-                    i_notion_task = NotionTaskRepository.update(i_notion_task)
+                task_logger.debug("--> Updating task from Google")
+                # The internal task is the task as of the last sync, the
+                # listed task is complete so there's no need to fetch it
+                base = i_task
+                i_task = i_task.update_from_params(
+                    g_task.dict(exclude={*GoogleTask.Meta.internal_fields}))
+
+                # When only the timestamp changed, for example by our own
+                # writes, Notion is left alone
+                if sync_notion and g_task.changed_fields(base, fields=GoogleTask.Meta.content_fields):
+                    i_notion_task: NotionTask = next(NotionTaskRepository.find(notion_id=i_task.notion_id))
+                    _, i_task = merge_tasks(
+                        base, i_notion_task.fetch(), i_task, self.buffer)
+                else:
+                    i_task.synced = datetime.now()
+                    i_task = GoogleTaskRepository.update(i_task)
 
-                i_task = GoogleTaskRepository.update(i_task)
                 return i_task
 
             elif g_task.updated < i_task.updated:
-                logger.debug("<-- Updating Google task")
-                i_task.google_save()
-                
+                task_logger.debug("<-- Updating Google task")
                 sync_time = datetime.now()
                 i_task.synced = sync_time
 
+                if not (fields := i_task.changed_fields(g_task)):
+                    # Nothing to write, only catch up with the Google timestamp
+                    i_task.updated = g_task.updated
+                    return GoogleTaskRepository.update(i_task)
+
+                notion_task = None
                 if sync_notion:
                     notion_task: NotionTask = next(NotionTaskRepository.find(
                         notion_id=i_task.notion_id
                     ))
                     notion_task.synced = sync_time
-                    notion_task = NotionTaskRepository.update(notion_task)
 
-                i_task = GoogleTaskRepository.update(i_task)
+                self.buffer.write("google", i_task, linked=notion_task, fields=fields)
                 return i_task
             
             else:
@@ -71,82 +104,165 @@ class GoogleSyncer:
                 return i_task
 
         except:
-            logger.debug('--> New task')
+            task_logger.debug('--> New task')
 
             try:
                 g_task.synced = datetime.now()
                 
                 if sync_notion:
                     notion_task = google_to_notion_task(g_task)
-                    notion_task = notion_task.notion_save()
+                    notion_task, g_task = Outbox.write("notion", notion_task, linked=g_task)
 
                     if notion_task.parent_task_ids:
-                        # Newly created task has parents, update them internally
-                        parent_task = next(NotionTaskRepository.find(notion_id=notion_task.parent_task_ids[0]))
-                        parent_task = parent_task.fetch()
-                        NotionTaskRepository.update(parent_task)
-
-                    g_task.notion_id = notion_task.notion_id
-                    notion_task = NotionTaskRepository.save(notion_task)
+                        # Newly created task has parents, update them
+                        # internally once all of their subtasks are created
+                        self.buffer.refresh("notion", notion_task.parent_task_ids[0])
+                else:
+                    g_task = GoogleTaskRepository.save(g_task)
 
-                g_task = GoogleTaskRepository.save(g_task)
                 return g_task
 
             except RuntimeError:
                 if fix_parent:
-                    logger.info("Parent error, fixing parent")
+                    task_logger.info("Parent error, fixing parent")
                     # Get parent task from Google and sync parent
                     google_parent_task = GoogleTasks.get(
                         g_task.tasklist, g_task.parent)
                     synced_parent = self.sync_task(google_parent_task, sync_notion=sync_notion)
-                    self.synced_tasks.append(synced_parent)
+                    if synced_parent:
+                        self.synced_task_ids.add(synced_parent.google_id)
 
                     # Try again
                     return self.sync_task(g_task, sync_notion=sync_notion)
 
                 else:
-                    logger.warn("Parent task did not exist in Notion, jumping this one for now")
+                    task_logger.warning("Parent task did not exist in Notion, jumping this one for now")
                     return
 
+    def task_edited_since(self, g_task: GoogleTask) -> datetime | None:
+        """Start of the last cycle that synced the tasklist of the task"""
+        return max(filter(None, [self.edited_since.get(None), self.edited_since.get(g_task.tasklist)]), default=None)
+
     def sync(self, tasklists:List[str]=None, sync_notion=True):
+        """Syncs the tasks of all tasklists, or only of the given tasklists.
+        Only the internal tasks of the synced tasklists are checked for
+        deletion.
+        """
         logger.debug("Syncing tasks FROM Google")
-        self.synced_tasks = []
-        google_tasks_to_sync = []
+        # Only the ids of the synced tasks are kept around for the deletion
+        # pass, the tasks themselves are dropped as soon as they are synced
+        self.synced_task_ids.close()
+        self.synced_task_ids = SpillSet()
+        cycle_start = datetime.utcnow()
+
+        google_tasks_to_sync = list_google_tasks(tasklists)
+
+        snapshot = None
+        # A snapshot holds the whole listing, scoped syncs are diffed against
+        # the internal tasks
+        if settings.sync_mode == "snapshot" and tasklists is None:
+            # Only the new and changed tasks are synced, the removed tasks are
+            # found once the listing is written
+            snapshot = Snapshot("google")
+            google_tasks_to_sync = snapshot.changed(google_tasks_to_sync)
+
+        # Tasks due soon and tasks edited since the last complete cycle go
+        # first, the other tasks only while the cycle is within its budget
+        queue = WorkQueue(google_tasks_to_sync, "google_id", edited_since=self.task_edited_since)
+
+        budget = Budget()
+        deferred, urgent_flushed = 0, False
+        for g_task, urgent in queue:
+            if not urgent and not urgent_flushed:
+                # The urgent writes don't wait for the background ones
+                self.buffer.flush()
+                urgent_flushed = True
+
+            if not urgent and budget.exhausted():
+                # Left for the next cycle, and not deleted in this one
+                self.synced_task_ids.add(g_task.google_id)
+                if snapshot:
+                    snapshot.forget(g_task.google_id)
+                deferred += 1
+                continue
 
-        if tasklists:
-            for tasklist_id in tasklists:
-                google_tasks_to_sync += list(GoogleTasks.list(tasklist_id=tasklist_id))
+            synced_task = self.sync_task(g_task, sync_notion=sync_notion)
+            if synced_task:
+                self.synced_task_ids.add(synced_task.google_id)
+            elif snapshot:
+                snapshot.forget(g_task.google_id)
+
+        # Each task is written at most once per cycle
+        self.buffer.flush()
+
+        if deferred or budget.exhausted():
+            logger.info("Out of budget, %s task(s) and the deletion pass are left for the next cycle", deferred)
+            # The listing still shows which missing tasks are back
+            Tombstones("google").clear_listed(snapshot or self.synced_task_ids)
         else:
-            google_tasks_to_sync = list(GoogleTasks.list())
+            if snapshot:
+                removed_task_ids = list(snapshot.removed_ids())
+            else:
+                removed_task_ids = [
+                    google_id for google_id in GoogleTaskRepository.find_ids("google_id", **tasklist_scope(tasklists))
+                    if google_id not in self.synced_task_ids
+                ]
+
+            # Removed tasks are only deleted once they are still missing after
+            # the grace window, in batches
+            tombstones = Tombstones("google")
+            tombstones.record(
+                removed_task_ids, snapshot or self.synced_task_ids,
+                GoogleTaskRepository._get_collection().count_documents(tasklist_scope(tasklists)))
+            tombstones.sweep(budget, sync_other=sync_notion)
+
+        if snapshot:
+            snapshot.commit()
+
+        for scope in [None] if tasklists is None else tasklists:
+            if not deferred or scope not in self.edited_since:
+                # Edits that were left for the next cycle stay urgent
+                self.edited_since[scope] = cycle_start
+        self.last_sync = datetime.now()
+
+    def plan(self, plan: Plan, tasklists: List[str] = None) -> Plan:
+        """Lists and diffs the tasks like `sync`, but only adds the operations
+        it would perform to the plan. Nothing is written.
+        """
+        logger.info("Planning the sync FROM Google")
+        listed_task_ids = SpillSet()
+        tasklist_sizes = Counter()
+
+        google_tasks_to_sync = list_google_tasks(tasklists)
+        scope = tasklist_scope(tasklists)
+        if tasklists is None:
+            # The tasklists are listed first
+            plan.calls["google"] += 1
+            tasklists = [tasklist.tasklist for tasklist in GoogleTasks.Meta.tasklists]
 
         for g_task in google_tasks_to_sync:
-            synced_task = self.sync_task(g_task, sync_notion=sync_notion)
-            self.synced_tasks.append(synced_task)
-
-        synced_task_ids = [task.google_id for task in self.synced_tasks]
-
-        for i_task in GoogleTaskRepository.find():
-            if i_task.google_id not in synced_task_ids:
-                # Remove internal task, this should remove the internal-
-                # and external Notion task as well
-                logger.debug(f'--x ({i_task.title}) Task removed in Google')
-                try:
-                    if sync_notion:
-                        i_notion_task: NotionTask = next(NotionTaskRepository.find(
-                            notion_id=i_task.notion_id
-                        ))
-                        i_notion_task.notion_delete()
-                        n_deleted = NotionTaskRepository._get_collection().delete_one({"notion_id": i_notion_task.notion_id})
-
-                        if n_deleted.deleted_count == 0:
-                            logger.error(f'Could not delete the corresponding internal Notion task of "{i_notion_task.title}" (nid={i_notion_task.notion_id})')
-                    
-                    g_deleted = GoogleTaskRepository._get_collection().delete_one({"google_id": i_task.google_id})
-
-                    if g_deleted.deleted_count == 0:
-                        logger.error(f'Could not delete the corresponding internal Google task of "{i_task.title}" (gid={i_task.google_id})')
-
-                except:
-                    logger.error(f'Could not find the internal NotionTask of task "{i_task.title}" (gid={i_task.google_id})')
+            listed_task_ids.add(g_task.google_id)
+            tasklist_sizes[g_task.tasklist] += 1
+            i_task: GoogleTask = next(GoogleTaskRepository.find(google_id=g_task.google_id), None)
+
+            if not i_task:
+                # The tasklist is fetched and the buckets are listed to find
+                # the task's bucket
+                plan.add("create", "notion", g_task.title, reads={"google": 1, "notion": 1})
+            elif g_task.updated > i_task.updated:
+                # The Notion task is fetched to be merged
+                if g_task.parent != i_task.parent:
+                    plan.add("move", "notion", g_task.title, reads={"notion": 1})
+                elif g_task.changed_fields(i_task, fields=GoogleTask.Meta.content_fields):
+                    plan.add("update", "notion", g_task.title, reads={"notion": 1})
+            elif g_task.updated < i_task.updated:
+                if i_task.changed_fields(g_task):
+                    plan.add("update", "google", g_task.title)
 
-        self.last_sync = datetime.now()
+        plan.add_listing("google", [tasklist_sizes[tasklist_id] for tasklist_id in tasklists])
+
+        for google_id in GoogleTaskRepository.find_ids("google_id", **scope):
+            if google_id not in listed_task_ids:
+                plan.add("delete", "notion", f"gid={google_id}")
+
+        return plan
@@ -0,0 +1,141 @@
+from datetime import date, datetime, time
+from typing import Dict, Tuple
+
+from app.models.google import GoogleTask
+from app.models.notion import NotionTask, NotionTime
+from app.models.mongo import GoogleTaskRepository, NotionTaskRepository
+from app.syncers.buffer import WriteBuffer
+from app.converters import google_to_notion_status, notion_to_google_status
+from app.config import settings
+
+logger = settings.logger
+
+# The fields present on both sides. They are compared in Google's vocabulary,
+# so a change that Google can't represent (like a Notion status mapped to the
+# same Google status) doesn't bounce back and forth.
+MERGE_FIELDS = ("title", "notes", "status", "due")
+
+
+def google_values(task: GoogleTask) -> dict:
+    return {
+        "title": task.title,
+        "notes": task.notes or None,
+        "status": task.status,
+        # Google only keeps the date of the due time
+        "due": task.due.date() if task.due else None,
+    }
+
+
+def notion_values(task: NotionTask) -> dict:
+    return {
+        "title": task.title,
+        "notes": task.notes or None,
+        "status": notion_to_google_status(task.status),
+        "due": task.due.datetime().date() if task.due else None,
+    }
+
+
+def conflict_policy(field: str) -> str:
+    """Returns the policy of a field, "notion", "google" or "latest" """
+    return settings.conflict_policies.get(field, settings.conflict_policy)
+
+
+def three_way_merge(base: dict, notion: dict, google: dict, notion_is_newer: bool) -> Tuple[Dict, Dict]:
+    """Merges the Notion and Google values of a task field by field, against
+    the values of the last sync. A field changed on one side only is copied
+    to the other side. A field changed on both sides is resolved by the
+    conflict policy of the field.
+
+    Returns:
+        [Tuple[Dict, Dict]]: The fields to write to Google and to Notion
+    """
+    to_google, to_notion = {}, {}
+
+    for field in MERGE_FIELDS:
+        if notion[field] == google[field]:
+            continue
+
+        notion_changed = notion[field] != base[field]
+        google_changed = google[field] != base[field]
+
+        if notion_changed != google_changed:
+            notion_wins = notion_changed
+        else:
+            policy = conflict_policy(field)
+            notion_wins = policy == "notion" or (policy == "latest" and notion_is_newer)
+            logger.info(
+                'Conflicting changes of "%s", keeping the %s value', field, "Notion" if notion_wins else "Google")
+
+        if notion_wins:
+            to_google[field] = notion[field]
+        else:
+            to_notion[field] = google[field]
+
+    return to_google, to_notion
+
+
+def to_datetime(d: date | None) -> datetime | None:
+    return datetime.combine(d, time()) if d else None
+
+
+def merge_tasks(base: GoogleTask, notion_task: NotionTask, google_task: GoogleTask,
+                buffer: WriteBuffer, base_values: dict = None) -> Tuple[NotionTask, GoogleTask]:
+    """Merges a task changed since the last sync and buffers the writes of the
+    changed fields only.
+
+    Args:
+        base (GoogleTask): The internal Google task, as of the last sync
+        notion_task (NotionTask): The task as it is on Notion, with the
+            internal fields
+        google_task (GoogleTask): The task as it is on Google, with the
+            internal fields
+        buffer (WriteBuffer): The buffer the writes are added to
+        base_values (dict, optional): Overrides the values of the last sync,
+            e.g. for tasks that have never been synced
+
+    Returns:
+        [Tuple[NotionTask, GoogleTask]]: The merged tasks
+    """
+    notion_is_newer = not google_task.updated or notion_task.updated.datetime() > google_task.updated
+    to_google, to_notion = three_way_merge(
+        google_values(base) | (base_values or {}), notion_values(notion_task), google_values(google_task), notion_is_newer)
+
+    notion_changes = {}
+    for field, value in to_notion.items():
+        if field == "status":
+            value = google_to_notion_status(value)
+        elif field == "due":
+            value = NotionTime.from_date(value) if value else None
+        notion_changes[field] = value
+
+    if google_task.parent != base.parent:
+        # Tasks can only be moved on Google
+        if not google_task.parent:
+            notion_changes["parent_task_ids"] = []
+        else:
+            try:
+                g_parent: GoogleTask = next(GoogleTaskRepository.find(google_id=google_task.parent))
+                notion_changes["parent_task_ids"] = [g_parent.notion_id]
+            except StopIteration:
+                logger.warning('The new parent of "%s" is not synced yet', google_task.title)
+
+    if "due" in to_google:
+        to_google["due"] = to_datetime(to_google["due"])
+
+    sync_time = datetime.now()
+    notion_task = notion_task.update_from_params(notion_changes | {"synced": sync_time})
+    google_task = google_task.update_from_params(to_google | {"synced": sync_time})
+
+    # A written task is saved internally from the provider's response, the
+    # other one is linked to the write unless it's written itself
+    if to_google:
+        buffer.write("google", google_task, linked=None if notion_changes else notion_task,
+                     fields=list(to_google))
+    if notion_changes:
+        buffer.write("notion", notion_task, linked=None if to_google else google_task,
+                     fields=list(notion_changes))
+    if not to_google and not notion_changes:
+        notion_task = NotionTaskRepository.upsert(notion_task, "notion_id")
+        google_task = GoogleTaskRepository.upsert(google_task, "google_id")
+
+    return notion_task, google_task
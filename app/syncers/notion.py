@@ -1,26 +1,82 @@
 from datetime import datetime
-from typing import List
+from typing import Dict, List, Tuple
 from app.models.google import GoogleTask
 
 from app.models.notion import NotionTask, NotionTasks
-from app.models.mongo import GoogleTaskRepository, NotionTaskRepository
+from app.models.mongo import GoogleTaskRepository, NotionTaskRepository, Outbox
+from app.syncers.buffer import WriteBuffer
+from app.syncers.merge import merge_tasks
+from app.syncers.snapshot import Snapshot
+from app.syncers.plan import Plan
+from app.syncers.priority import Budget, WorkQueue
+from app.syncers.tombstones import Tombstones
+from app.spill import SpillSet
 from app.converters import notion_to_google_task
 from app.config import settings
 
 
 logger = settings.logger
+task_logger = settings.task_logger
+
+
+def list_notion_tasks(buckets: List[str] = None):
+    """Lists the syncable tasks, only the ones in the given buckets if any"""
+    if buckets is None:
+        return NotionTasks().list_syncable()
+    if not buckets:
+        return iter(())
+    return NotionTasks().list_syncable(filter={"or": [
+        {"property": "Bucket", "relation": {"contains": bucket_id}} for bucket_id in buckets
+    ]})
+
+
+def split_unsyncable(task_ids: List[str], buckets: List[str] = None) -> Tuple[List[str], List[str]]:
+    """Splits the internal tasks missing from the listing into the removed
+    tasks and the ones that still exist but are not synced, because they lost
+    their bucket or status or moved to another bucket. The tasks that are not
+    synced are listed with a single query.
+    """
+    if not task_ids:
+        return [], []
+
+    unsyncable_filter = None
+    if buckets is not None:
+        unsyncable_filter = {"and": [
+            {"property": "Bucket", "relation": {"does_not_contain": bucket_id}} for bucket_id in buckets
+        ]}
+    unsyncable_ids = SpillSet()
+    for notion_id in NotionTasks().list_unsyncable_ids(filter=unsyncable_filter):
+        unsyncable_ids.add(notion_id)
+
+    removed_ids, kept_ids = [], []
+    for notion_id in task_ids:
+        (kept_ids if notion_id in unsyncable_ids else removed_ids).append(notion_id)
+    unsyncable_ids.close()
+    return removed_ids, kept_ids
+
+
+def bucket_scope(buckets: List[str] = None) -> dict:
+    """The MongoDB filter of the internal tasks in the given buckets"""
+    return {} if buckets is None else {"bucket_id": {"$in": buckets}}
+
 
 class NotionSyncer:
 
     last_sync: datetime
-    synced_tasks: List[NotionTask]
+    # Start of the last cycle that synced every listed task, or of the
+    # first cycle, by bucket. None stands for the cycles of all buckets.
+    edited_since: Dict[str | None, datetime]
+    synced_task_ids: SpillSet
+    buffer: WriteBuffer
 
     def __init__(self) -> None:
         self.last_sync = None
-        self.synced_tasks = []
+        self.edited_since = {}
+        self.synced_task_ids = SpillSet()
+        self.buffer = WriteBuffer()
 
     def sync_task(self, n_task: NotionTask, fix_parent=True, sync_google=True) -> NotionTask:
-        logger.debug(f'Syncing task "{n_task.title}"')
+        task_logger.debug('Syncing task "%s"', n_task.title, extra={"notion_id": n_task.notion_id})
 
         try:
             # Check if task exists internally
@@ -29,38 +85,43 @@ class NotionSyncer:
             if n_task.updated > i_task.updated:
                 # The Notion task is newer, update internal tasks
                 # Should trigger an update at Google as well
-                logger.debug("--> Updating task from Notion")
-                i_task = i_task.fetch()
-                i_task.synced = datetime.now()
+                task_logger.debug("--> Updating task from Notion")
+                changed_fields = n_task.changed_fields(i_task, fields=NotionTask.Meta.content_fields)
+                # The listed task is complete, no need to fetch it again
+                i_task = i_task.update_from_params(
+                    n_task.dict(exclude={*NotionTask.Meta.internal_fields}))
 
-                if sync_google:
+                # When only the timestamp or the subtasks changed, for example
+                # by our own writes, Google is left alone
+                if sync_google and changed_fields:
+                    # The internal Google task is the task as of the last sync,
+                    # the task may have changed on Google since then
                     i_google_task: GoogleTask = next(GoogleTaskRepository.find(google_id=i_task.google_id))
+                    i_task, _ = merge_tasks(
+                        i_google_task, i_task, i_google_task.fetch(), self.buffer)
+                else:
+                    i_task.synced = datetime.now()
+                    i_task = NotionTaskRepository.update(i_task)
 
-                    i_google_task = i_google_task.update_from_params(
-                        notion_to_google_task(i_task).dict(
-                            exclude={*GoogleTask.Meta.internal_fields}
-                        )
-                    )
-                    i_google_task = i_google_task.google_save()
-                    i_google_task = GoogleTaskRepository.update(i_google_task)
-                    
-                i_task = NotionTaskRepository.update(i_task)
                 return i_task
 
             elif n_task.updated < i_task.updated:
-                logger.debug("<-- Updating Notion task")
-                i_task.notion_save()
-
+                task_logger.debug("<-- Updating Notion task")
                 sync_time = datetime.now()
                 i_task.synced = sync_time
 
+                if not (fields := i_task.changed_fields(n_task)):
+                    # Nothing to write, only catch up with the Notion timestamp
+                    i_task.updated = n_task.updated
+                    return NotionTaskRepository.update(i_task)
+
+                google_task = None
                 if sync_google:
                     google_task: GoogleTask = next(GoogleTaskRepository.find(
                         google_id=i_task.google_id))
                     google_task.synced = sync_time
-                    google_task = GoogleTaskRepository.update(google_task)
 
-                i_task = NotionTaskRepository.update(i_task)
+                self.buffer.write("notion", i_task, linked=google_task, fields=fields)
                 return i_task
             
             else:
@@ -69,26 +130,24 @@ class NotionSyncer:
 
         except:
             if not n_task.bucket_id:
-                logger.info("Task does not have a bucket, do not sync to Google")
+                task_logger.info("Task does not have a bucket, do not sync to Google")
                 return
 
             if not n_task.status:
-                logger.info("Task does not have status set, do not sync to Google")
+                task_logger.info("Task does not have status set, do not sync to Google")
                 return
 
-            logger.debug('--> New task')
+            task_logger.debug('--> New task')
 
             try:
                 n_task.synced = datetime.now()
 
                 if sync_google:
                     google_task = notion_to_google_task(n_task)
-                    google_task = google_task.google_save()
-                    
-                    n_task.google_id = google_task.google_id
-                    google_task = GoogleTaskRepository.save(google_task)
+                    _, n_task = Outbox.write("google", google_task, linked=n_task)
+                else:
+                    n_task = NotionTaskRepository.save(n_task)
 
-                n_task = NotionTaskRepository.save(n_task)
                 return n_task
 
             except RuntimeError:
@@ -96,50 +155,148 @@ class NotionSyncer:
                     # Get parent task from Notion and sync parent
                     notion_parent_task = NotionTasks.get(n_task.parent_task_ids[0])
                     synced_parent = self.sync_task(notion_parent_task, sync_google=sync_google)
-                    self.synced_tasks.append(synced_parent)
+                    if synced_parent:
+                        self.synced_task_ids.add(synced_parent.notion_id)
 
                     # Try again
                     return self.sync_task(n_task, sync_google=sync_google)
                 
                 else:
-                    logger.warn("Parent task did not exist in Google, jumping this one for now")
+                    task_logger.warning("Parent task did not exist in Google, jumping this one for now")
                     return
 
 
-    def sync(self, sync_google=True):
+    def task_edited_since(self, n_task: NotionTask) -> datetime | None:
+        """Start of the last cycle that synced the bucket of the task"""
+        return max(filter(None, [self.edited_since.get(None), self.edited_since.get(n_task.bucket_id)]), default=None)
+
+    def sync(self, sync_google=True, buckets: List[str] = None):
+        """Syncs the tasks of all buckets, or only of the given buckets. Only
+        the internal tasks of the synced buckets are checked for deletion.
+        """
         logger.info('Syncing tasks FROM Notion')
-        self.synced_tasks = []
+        # Only the ids of the synced tasks are kept around for the deletion
+        # pass, the tasks themselves are dropped as soon as they are synced
+        self.synced_task_ids.close()
+        self.synced_task_ids = SpillSet()
+        cycle_start = datetime.utcnow()
+
+        notion_tasks_to_sync = list_notion_tasks(buckets)
+
+        snapshot = None
+        # A snapshot holds the whole listing, scoped syncs are diffed against
+        # the internal tasks
+        if settings.sync_mode == "snapshot" and buckets is None:
+            # Only the new and changed tasks are synced, the removed tasks are
+            # found once the listing is written
+            snapshot = Snapshot("notion")
+            notion_tasks_to_sync = snapshot.changed(notion_tasks_to_sync)
+
+        # Tasks due soon and tasks edited since the last complete cycle go
+        # first, the other tasks only while the cycle is within its budget
+        queue = WorkQueue(notion_tasks_to_sync, "notion_id", edited_since=self.task_edited_since)
+
+        budget = Budget()
+        deferred, urgent_flushed = 0, False
+        for n_task, urgent in queue:
+            if not urgent and not urgent_flushed:
+                # The urgent writes don't wait for the background ones
+                self.buffer.flush()
+                urgent_flushed = True
+
+            if not urgent and budget.exhausted():
+                # Left for the next cycle, and not deleted in this one
+                self.synced_task_ids.add(n_task.notion_id)
+                if snapshot:
+                    snapshot.forget(n_task.notion_id)
+                deferred += 1
+                continue
 
-        for n_task in NotionTasks().list():
             synced_task = self.sync_task(n_task, sync_google=sync_google)
-            self.synced_tasks.append(synced_task)
-
-        synced_task_ids = []
-        for task in self.synced_tasks:
-            if task:
-                synced_task_ids.append(task.notion_id)
-
-        for i_task in NotionTaskRepository.find():
-            if i_task.notion_id not in synced_task_ids:
-                # Remove internal task, this should remove the internal-
-                # and external Google task as well 
-                logger.debug(f'--x ({i_task.title}) Task removed in Notion')
-                try:
-                    if sync_google:
-                        i_google_task: GoogleTask = next(GoogleTaskRepository.find(
-                            google_id=i_task.google_id))
-                        i_google_task.google_delete()
-                        g_deleted = GoogleTaskRepository._get_collection().delete_one({"google_id": i_google_task.google_id})
-                        
-                        if g_deleted.deleted_count == 0:
-                            logger.error(f'Could not delete the corresponding internal Google task of "{i_google_task.title}" (gid={i_google_task.google_id})')
-
-                    n_deleted = NotionTaskRepository._get_collection().delete_one({"notion_id": i_task.notion_id})
-
-                    if n_deleted.deleted_count == 0:
-                        logger.error(f'Could not delete the corresponding internal Notion task of "{i_task.title}" (nid={i_task.notion_id})')
-                    
-                except:
-                    logger.error("Could not remove task internally or in Google")
+            if synced_task:
+                self.synced_task_ids.add(synced_task.notion_id)
+            elif snapshot:
+                snapshot.forget(n_task.notion_id)
+
+        # Each task is written at most once per cycle
+        self.buffer.flush()
+
+        if deferred or budget.exhausted():
+            logger.info("Out of budget, %s task(s) and the deletion pass are left for the next cycle", deferred)
+            # The listing still shows which missing tasks are back
+            Tombstones("notion").clear_listed(snapshot or self.synced_task_ids)
+        else:
+            if snapshot:
+                removed_task_ids = list(snapshot.removed_ids())
+            else:
+                removed_task_ids = [
+                    notion_id for notion_id in NotionTaskRepository.find_ids("notion_id", **bucket_scope(buckets))
+                    if notion_id not in self.synced_task_ids
+                ]
+
+            tombstones = Tombstones("notion")
+            total = NotionTaskRepository._get_collection().count_documents(bucket_scope(buckets))
+            if tombstones.truncated(len(removed_task_ids), total):
+                removed_task_ids = []
+            else:
+                # Only the syncable tasks are listed, the missing ones may
+                # still exist without a bucket or status
+                removed_task_ids, kept_task_ids = split_unsyncable(removed_task_ids, buckets)
+                tombstones.clear(kept_task_ids)
+
+            # Removed tasks are only deleted once they are still missing after
+            # the grace window, in batches
+            tombstones.record(removed_task_ids, snapshot or self.synced_task_ids, total)
+            tombstones.sweep(budget, sync_other=sync_google)
+
+        if snapshot:
+            snapshot.commit()
 
+        for scope in [None] if buckets is None else buckets:
+            if not deferred or scope not in self.edited_since:
+                # Edits that were left for the next cycle stay urgent
+                self.edited_since[scope] = cycle_start
         self.last_sync = datetime.now()
+
+    def plan(self, plan: Plan, buckets: List[str] = None) -> Plan:
+        """Lists and diffs the tasks like `sync`, but only adds the operations
+        it would perform to the plan. Nothing is written.
+        """
+        logger.info("Planning the sync FROM Notion")
+        listed_task_ids = SpillSet()
+
+        for n_task in list_notion_tasks(buckets):
+            listed_task_ids.add(n_task.notion_id)
+            i_task: NotionTask = next(NotionTaskRepository.find(notion_id=n_task.notion_id), None)
+
+            if not i_task:
+                # The bucket is fetched and the tasklists are listed to find
+                # the task's tasklist
+                plan.add("create", "google", n_task.title, reads={"notion": 1, "google": 1})
+            elif n_task.updated > i_task.updated:
+                if n_task.changed_fields(i_task, fields=NotionTask.Meta.content_fields):
+                    # The Google task is fetched to be merged
+                    plan.add("update", "google", n_task.title, reads={"google": 1})
+            elif n_task.updated < i_task.updated:
+                if i_task.changed_fields(n_task):
+                    plan.add("update", "notion", n_task.title)
+
+        plan.add_listing("notion", [len(listed_task_ids)])
+
+        missing_task_ids = [
+            notion_id for notion_id in NotionTaskRepository.find_ids("notion_id", **bucket_scope(buckets))
+            if notion_id not in listed_task_ids
+        ]
+        total = NotionTaskRepository._get_collection().count_documents(bucket_scope(buckets))
+        if Tombstones("notion").truncated(len(missing_task_ids), total):
+            return plan
+
+        removed_task_ids, kept_task_ids = split_unsyncable(missing_task_ids, buckets)
+        if missing_task_ids:
+            # The query of the tasks that are not synced, an estimate as only
+            # the missing ones are counted
+            plan.add_listing("notion", [len(kept_task_ids)])
+        for notion_id in removed_task_ids:
+            plan.add("delete", "google", f"nid={notion_id}")
+
+        return plan
@@ -0,0 +1,66 @@
+from collections import Counter
+from math import ceil
+from typing import Dict, List, Tuple
+
+from app.config import settings
+
+logger = settings.logger
+
+# Tasks per page of the Notion and Google listings
+PAGE_SIZE = 100
+
+
+class Plan:
+    """The operations a sync cycle would perform and the API calls they take,
+    computed without writing anything.
+    """
+
+    operations: List[Tuple[str, str, str]]
+    calls: Counter
+
+    def __init__(self) -> None:
+        self.operations = []
+        self.calls = Counter()
+
+    def add(self, operation: str, provider: str, title: str, reads: Dict[str, int] = None):
+        """Plans an operation.
+
+        Args:
+            operation (str): "create", "update", "delete" or "move"
+            provider (str): The provider written to, "google" or "notion"
+            title (str): The title of the task
+            reads (Dict[str, int], optional): The calls made to read tasks
+                before the write, by provider
+        """
+        self.operations.append((operation, provider, title))
+        self.calls[provider] += 1
+        self.calls.update(reads or {})
+
+    def add_listing(self, provider: str, list_sizes: List[int]):
+        """Counts the calls made to list the tasks of a provider, given the
+        number of tasks of each listed database or tasklist
+        """
+        self.calls[provider] += sum(max(ceil(size / PAGE_SIZE), 1) for size in list_sizes)
+
+    def estimated_seconds(self) -> float | None:
+        """The wall time the calls take under the configured rate limits, the
+        syncers make one call at a time. None if a provider has no limit.
+        """
+        rates = {"google": settings.google_rate_limit, "notion": settings.notion_rate_limit}
+        if any(self.calls[provider] and not rate for provider, rate in rates.items()):
+            return None
+        return sum(self.calls[provider] / rate for provider, rate in rates.items() if rate)
+
+    def log(self):
+        for operation, provider, title in self.operations:
+            logger.debug('%s in %s: "%s"', operation, provider, title)
+
+        counts = Counter((operation, provider) for operation, provider, _ in self.operations)
+        for (operation, provider), count in sorted(counts.items()):
+            logger.info(f"{operation} in {provider}: {count} task(s)")
+
+        logger.info(f"API calls: {self.calls['notion']} to Notion, {self.calls['google']} to Google")
+        if (seconds := self.estimated_seconds()) is not None:
+            logger.info(f"Estimated time under the rate limits: {seconds:.0f} seconds")
+        else:
+            logger.info("No rate limit configured, the time can't be estimated")
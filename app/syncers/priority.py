@@ -0,0 +1,106 @@
+import heapq
+from datetime import datetime, timedelta, timezone
+from time import monotonic
+from typing import Callable, Iterable, Iterator, Tuple
+
+from app.models.google import GoogleStatus
+from app.models.notion import NotionStatus
+from app.converters import notion_to_google_status
+from app.spill import SpillDict
+from app.config import settings
+
+# Tiers of the work queue, lower tiers are synced first
+URGENT, BACKGROUND = 0, 1
+
+
+def utc(value) -> datetime | None:
+    """A NotionTime or datetime as a naive UTC datetime, like the timestamps
+    of both providers"""
+    if value is None:
+        return None
+    if not isinstance(value, datetime):
+        value = value.datetime()
+    if value.tzinfo:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def completed(task) -> bool:
+    """Whether a Google task, or a Notion task whose status maps to a
+    completed Google task, is done"""
+    status = task.status
+    if isinstance(status, NotionStatus):
+        status = notion_to_google_status(status)
+    return status == GoogleStatus.done
+
+
+def priority(task, edited_since: datetime | None, now: datetime) -> tuple:
+    """The sort key of a listed task. Open tasks due within `due_soon_hours`
+    of now and tasks edited since `edited_since` are urgent, the ones due
+    first and then the ones edited last come first.
+    """
+    due, updated = utc(task.due), utc(task.updated)
+    window = timedelta(hours=settings.due_soon_hours)
+    due_soon = due is not None and now - window <= due <= now + window and not completed(task)
+    edited = edited_since is not None and updated is not None and updated > edited_since
+
+    return (
+        URGENT if due_soon or edited else BACKGROUND,
+        due if due_soon else datetime.max,
+        -updated.timestamp() if updated else 0,
+    )
+
+
+class Budget:
+    """The time a sync cycle may take, None means no limit"""
+
+    def __init__(self, seconds: float = None) -> None:
+        seconds = settings.cycle_budget if seconds is None else seconds
+        self.deadline = monotonic() + seconds if seconds else None
+
+    def exhausted(self) -> bool:
+        return self.deadline is not None and monotonic() > self.deadline
+
+
+class WorkQueue:
+    """Orders the listed tasks of a cycle by priority while they are listed,
+    so user visible changes are synced before the background reconciliation
+    of the other tasks. Urgent tasks are yielded as soon as they are listed.
+    The background tasks wait in a SpillDict, only their ids and priorities
+    are kept in the heap, and they are yielded once the listing is over, the
+    ones edited last first. Without a cycle budget every task is synced in
+    the cycle anyway, so the tasks are yielded in the order they are listed.
+    `edited_since` gives the time after which an edit of a task is urgent.
+    """
+
+    def __init__(self, tasks: Iterable, id_field: str,
+                 edited_since: Callable[[object], datetime | None] = None) -> None:
+        self.tasks = tasks
+        self.id_field = id_field
+        self.edited_since = edited_since
+        self.now = datetime.utcnow()
+
+    def __iter__(self) -> Iterator[Tuple[object, bool]]:
+        """Streams the tasks, urgent ones first if there is a cycle budget
+
+        Yields:
+            [Tuple[object, bool]]: The task and whether it's urgent
+        """
+        heap = []
+        background = SpillDict()
+        try:
+            for task in self.tasks:
+                key = priority(task, self.edited_since(task) if self.edited_since else None, self.now)
+                if key[0] == URGENT or not settings.cycle_budget:
+                    yield task, key[0] == URGENT
+                    continue
+
+                task_id = getattr(task, self.id_field)
+                heapq.heappush(heap, (key, task_id))
+                background[task_id] = task
+
+            while heap:
+                _, task_id = heapq.heappop(heap)
+                yield background.get(task_id), False
+        finally:
+            background.close()
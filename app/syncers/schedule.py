@@ -0,0 +1,67 @@
+from datetime import datetime
+from typing import Dict, Iterable, List
+
+from app.models.google import GoogleTaskLists
+from app.models.notion import NotionBuckets
+from app.config import settings
+
+logger = settings.logger
+
+
+class ScopeSchedule:
+    """Syncs every bucket and tasklist on its own schedule. A scope is a
+    bucket and the tasklist of the same title, synced in both directions
+    every `scope_intervals[title]` seconds, or every `default_interval`
+    seconds if it has no interval of its own.
+    """
+
+    default_interval: float
+    intervals: Dict[str, float]
+    last_synced: Dict[str, datetime]
+
+    def __init__(self, default_interval: float, intervals: Dict[str, float] = None) -> None:
+        self.default_interval = default_interval
+        self.intervals = settings.scope_intervals if intervals is None else intervals
+        self.last_synced = {}
+        self.titles = []
+
+    def interval(self, title: str) -> float:
+        return self.intervals.get(title, self.default_interval)
+
+    def due(self, titles: Iterable[str], now: datetime = None) -> List[str]:
+        """The scopes that have never been synced or whose interval is over"""
+        now = now or datetime.now()
+        return [
+            title for title in titles
+            if title not in self.last_synced
+            or (now - self.last_synced[title]).total_seconds() >= self.interval(title)
+        ]
+
+    def wait(self, now: datetime = None) -> float:
+        """Seconds until the next scope is due"""
+        now = now or datetime.now()
+        if not self.titles:
+            return self.default_interval
+        return max(min(
+            self.interval(title) - (now - self.last_synced.get(title, now)).total_seconds()
+            for title in self.titles
+        ), 0)
+
+    def sync(self, notion_syncer, google_syncer):
+        """Syncs the scopes that are due"""
+        buckets = {bucket.title: bucket.notion_id for bucket in NotionBuckets().list()}
+        tasklists = {tasklist.title: tasklist.tasklist for tasklist in GoogleTaskLists.list()}
+        self.titles = list({**buckets, **tasklists})
+
+        now = datetime.now()
+        due = self.due(self.titles, now)
+        logger.info(f"Syncing {len(due)} of {len(self.titles)} bucket(s) and tasklist(s)")
+        if not due:
+            return
+
+        # A failing scope is retried when its interval is over again
+        for title in due:
+            self.last_synced[title] = now
+
+        notion_syncer.sync(buckets=[buckets[title] for title in due if title in buckets])
+        google_syncer.sync(tasklists=[tasklists[title] for title in due if title in tasklists])
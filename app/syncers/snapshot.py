@@ -0,0 +1,101 @@
+import hashlib
+import json
+from itertools import islice
+from typing import Iterable, Iterator
+from uuid import uuid4
+
+from mongomantic.core.database import MongomanticClient
+
+from app.models.mongo import Outbox
+from app.syncers.priority import utc
+from app.config import settings
+
+logger = settings.logger
+
+
+def content_hash(task) -> str:
+    """Hashes the fields of a task edited by users"""
+    content = task.dict(include=set(task.Meta.content_fields))
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class Snapshot:
+    """The listing of a provider in a sync cycle, written to a temporary
+    collection as one (id, updated, hash) row per task. The listed tasks are
+    compared with the snapshot of the previous cycle and with the internal
+    tasks while they are written, so only the new and changed tasks are
+    synced and the listing is never held in memory.
+
+    Once the cycle is done the snapshot replaces the one of the previous cycle,
+    which the next cycle is diffed against.
+    """
+
+    batch_size = 1000
+
+    def __init__(self, provider: str) -> None:
+        self.model, self.repository, self.id_field, _ = Outbox.providers[provider]
+        self.name = f"snapshot-{provider}"
+
+        # Snapshots left behind by interrupted cycles
+        for name in MongomanticClient.db.list_collection_names(filter={"name": {"$regex": f"^{self.name}-"}}):
+            MongomanticClient.db.drop_collection(name)
+
+        self.collection = MongomanticClient.db[f"{self.name}-{uuid4().hex[:8]}"]
+
+    def _row(self, task) -> dict:
+        return {
+            "_id": getattr(task, self.id_field),
+            "updated": utc(task.updated),
+            "hash": content_hash(task),
+        }
+
+    def changed(self, tasks: Iterable) -> Iterator:
+        """Writes the listed tasks to the snapshot, batch by batch, and yields
+        the tasks that are new or have changed since the previous cycle, or
+        that are missing internally
+        """
+        tasks = iter(tasks)
+        listed, changed = 0, 0
+        while batch := list(islice(tasks, self.batch_size)):
+            rows = [self._row(task) for task in batch]
+            self.collection.insert_many(rows, ordered=False)
+
+            task_ids = [row["_id"] for row in rows]
+            previous = {
+                row["_id"]: row["hash"]
+                for row in MongomanticClient.db[self.name].find({"_id": {"$in": task_ids}}, {"hash": 1})
+            }
+            internal = set(self.repository.find_ids(self.id_field, **{self.id_field: {"$in": task_ids}}))
+
+            for task, row in zip(batch, rows):
+                if previous.get(row["_id"]) != row["hash"] or row["_id"] not in internal:
+                    changed += 1
+                    yield task
+            listed += len(batch)
+
+        logger.info(f"{changed} of {listed} listed task(s) are new or changed")
+
+    def removed_ids(self) -> Iterator[str]:
+        """Yields the ids of the internal tasks that are not listed anymore,
+        once the listing has been written"""
+        pipeline = [
+            {"$project": {self.id_field: 1}},
+            {"$lookup": {"from": self.collection.name, "localField": self.id_field, "foreignField": "_id", "as": "listed"}},
+            {"$match": {"listed": {"$size": 0}}},
+            {"$project": {"_id": f"${self.id_field}"}},
+        ]
+        for row in self.repository._get_collection().aggregate(pipeline):
+            yield row["_id"]
+
+    def __contains__(self, task_id: str) -> bool:
+        """Whether the task is in the listing"""
+        return self.collection.count_documents({"_id": task_id}, limit=1) > 0
+
+    def forget(self, task_id: str):
+        """Marks a task that could not be synced as changed, so it's synced
+        again in the next cycle. It stays listed."""
+        self.collection.update_one({"_id": task_id}, {"$set": {"hash": None}})
+
+    def commit(self):
+        """Replaces the snapshot of the previous cycle with this one"""
+        self.collection.rename(self.name, dropTarget=True)
@@ -0,0 +1,209 @@
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import Container, Iterable, List
+
+from googleapiclient.errors import HttpError
+from notion_client.errors import APIErrorCode, APIResponseError
+from pymongo import UpdateOne
+
+from app.models.google import google_pool
+from app.models.mongo import Outbox, TombstoneRepository
+from app.syncers.priority import Budget
+from app.config import settings
+
+logger = settings.logger
+task_logger = settings.task_logger
+
+# Methods deleting a task on its provider
+delete_methods = {"google": "google_delete", "notion": "notion_delete"}
+
+
+def linked_provider(provider: str) -> str:
+    return "notion" if provider == "google" else "google"
+
+
+def already_deleted(error: Exception) -> bool:
+    """Whether a provider delete failed because the task is already gone"""
+    if isinstance(error, HttpError):
+        return error.resp.status in (404, 410)
+    if isinstance(error, APIResponseError):
+        # Notion refuses to edit archived pages
+        return error.code == APIErrorCode.ObjectNotFound or (
+            error.code == APIErrorCode.ValidationError and "archived" in str(error))
+    return False
+
+
+class Tombstones:
+    """Deletions go through tombstones in MongoDB. A task missing from a
+    listing gets a tombstone, which is cleared if the task shows up again. Once
+    the task is still missing after the grace window the tombstone is
+    confirmed, and `sweep` deletes the linked task on the other provider and
+    both internal tasks in batches. The provider clients are rate limited, so
+    the batches are too.
+    """
+
+    # Listings missing fewer tasks than this are never considered truncated
+    guard_minimum = 10
+
+    provider: str
+
+    def __init__(self, provider: str) -> None:
+        self.provider = provider
+        self.collection = TombstoneRepository._get_collection()
+
+    def record(self, missing_ids: List[str], listed_ids: Container[str], total: int) -> int:
+        """Records the tasks missing from a listing and clears the tombstones
+        of the listed tasks.
+
+        Args:
+            missing_ids (List[str]): The internal tasks missing from the listing
+            listed_ids (Container[str]): The tasks in the listing, their
+                tombstones are cleared
+            total (int): The internal tasks the listing is compared with
+
+        Returns:
+            [int]: The number of tombstones recorded, 0 if the listing looks
+                truncated
+        """
+        self.clear_listed(listed_ids)
+
+        if self.truncated(len(missing_ids), total):
+            return 0
+
+        now = datetime.now()
+        for batch in self.batches(missing_ids):
+            self.collection.bulk_write([
+                UpdateOne(
+                    {"provider": self.provider, "task_id": task_id},
+                    {"$setOnInsert": {"first_missing": now, "confirmed": False, "attempts": 0}},
+                    upsert=True)
+                for task_id in batch
+            ], ordered=False)
+            self.collection.update_many({
+                "provider": self.provider,
+                "task_id": {"$in": batch},
+                "first_missing": {"$lte": now - timedelta(seconds=settings.tombstone_grace)},
+            }, {"$set": {"confirmed": True}})
+
+        return len(missing_ids)
+
+    def clear_listed(self, listed_ids: Container[str]):
+        """Clears the tombstones of the tasks that are listed again, so their
+        grace window starts over if they go missing later"""
+        for tombstone in self.collection.find({"provider": self.provider}, {"task_id": 1}):
+            if tombstone["task_id"] in listed_ids:
+                task_logger.debug("Task %s is listed again, clearing its tombstone", tombstone["task_id"])
+                self.collection.delete_one({"_id": tombstone["_id"]})
+
+    def truncated(self, missing: int, total: int) -> bool:
+        """Whether a listing missing this many of the internal tasks looks
+        truncated, in which case nothing is deleted"""
+        if missing >= self.guard_minimum and missing > settings.max_delete_ratio * total:
+            logger.error(
+                "%s of %s %s task(s) are missing from the listing, it's treated as truncated and nothing is "
+                "deleted. Raise MAX_DELETE_RATIO if the tasks were removed on purpose.",
+                missing, total, self.provider)
+            return True
+        return False
+
+    def clear(self, task_ids: Iterable[str]):
+        """Clears the tombstones of tasks that turned out not to be removed"""
+        for batch in self.batches(task_ids):
+            self.collection.delete_many({"provider": self.provider, "task_id": {"$in": batch}})
+
+    def sweep(self, budget: Budget = None, sync_other=True) -> int:
+        """Deletes the tasks of the confirmed tombstones in the background, at
+        most `tombstone_batches` batches per cycle and only while the cycle is
+        within its budget.
+
+        Args:
+            budget (Budget, optional): The budget of the cycle
+            sync_other (bool): Whether to delete the linked tasks on the other
+                provider and internally
+
+        Returns:
+            [int]: The number of deleted tasks
+
+        Raises:
+            LeaseLostError: If the lease the writes are fenced with is lost
+        """
+        budget = budget or Budget()
+        deleted = 0
+        for _ in range(settings.tombstone_batches):
+            if budget.exhausted():
+                break
+            # Deletes are provider writes too, they stop once the lease is lost
+            Outbox.check_lease()
+
+            batch = [
+                tombstone["task_id"] for tombstone in self.collection.find(
+                    {"provider": self.provider, "confirmed": True},
+                    {"task_id": 1}
+                ).sort("attempts", 1).limit(settings.tombstone_batch)
+            ]
+            if not batch:
+                break
+
+            results = list(google_pool.map(lambda task_id: self.delete_linked(task_id, sync_other), batch))
+            done = [task_id for task_id, result in zip(batch, results) if result is not None]
+            self.delete_internal(done, [result for result in results if result])
+
+            failed = [task_id for task_id in batch if task_id not in done]
+            if failed:
+                self.collection.update_many(
+                    {"provider": self.provider, "task_id": {"$in": failed}}, {"$inc": {"attempts": 1}})
+            deleted += len(done)
+            if len(done) < len(batch) or len(batch) < settings.tombstone_batch:
+                # Failed deletes are retried in the next cycle
+                break
+
+        if deleted:
+            logger.info("Deleted %s task(s) removed in %s", deleted, self.provider.capitalize())
+        return deleted
+
+    def delete_linked(self, task_id: str, sync_other=True) -> str | None:
+        """Deletes the task linked to a removed task on the other provider
+
+        Returns:
+            [str | None]: The id of the linked task, "" if there is none and
+                None if the delete failed
+        """
+        _, repository, id_field, _ = Outbox.providers[self.provider]
+        other = linked_provider(self.provider)
+        _, linked_repository, linked_id_field, _ = Outbox.providers[other]
+
+        i_task = next(repository.find(**{id_field: task_id}), None)
+        linked_id = getattr(i_task, linked_id_field, None) if i_task else None
+        if not linked_id or not sync_other:
+            # The linked tasks are left alone
+            return ""
+
+        try:
+            if i_linked := next(linked_repository.find(**{linked_id_field: linked_id}), None):
+                task_logger.debug('--x (%s) Task removed in %s', i_task.title, self.provider.capitalize())
+                getattr(i_linked, delete_methods[other])()
+            return linked_id
+        except Exception as e:
+            if already_deleted(e):
+                # Removed on both sides within the grace window
+                task_logger.debug('"%s" is already deleted in %s', i_task.title, other.capitalize())
+                return linked_id
+            logger.error('Could not delete "%s" in %s: %s', i_task.title, other.capitalize(), e)
+            return None
+
+    def delete_internal(self, task_ids: List[str], linked_ids: List[str]):
+        """Deletes the internal tasks and the tombstones of deleted tasks"""
+        if not task_ids:
+            return
+        _, repository, id_field, _ = Outbox.providers[self.provider]
+        _, linked_repository, linked_id_field, _ = Outbox.providers[linked_provider(self.provider)]
+
+        repository._get_collection().delete_many({id_field: {"$in": task_ids}})
+        if linked_ids:
+            linked_repository._get_collection().delete_many({linked_id_field: {"$in": linked_ids}})
+        self.collection.delete_many({"provider": self.provider, "task_id": {"$in": task_ids}})
+
+    def batches(self, task_ids: Iterable[str]):
+        task_ids = iter(task_ids)
+        while batch := list(islice(task_ids, settings.tombstone_batch)):
+            yield batch
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import multiprocessing
+import os
+from bisect import bisect
+from time import sleep
+from typing import Dict, Iterable, List, Tuple
+
+from google.oauth2.credentials import Credentials
+
+from app.models import notion
+from app.models.google import SCOPES, google_tasklists, use_google_credentials
+from app.models.mongo import Outbox, Tenant, TenantRepository, connect_mongo, mongo_uri, use_mongo_db
+from app.leases import LeaseKeeper
+from app.profiling import CycleProfiler
+from app.syncers.google import GoogleSyncer
+from app.syncers.notion import NotionSyncer
+from app.config import settings
+
+logger = settings.logger
+
+
+class HashRing:
+    """Consistent hashing of tenants onto workers. Adding or removing a
+    worker only moves the tenants of the neighbouring ring segments.
+    """
+
+    def __init__(self, nodes: Iterable[int], replicas: int = 100) -> None:
+        ring = []
+        for node in nodes:
+            for replica in range(replicas):
+                ring.append((self._hash(f"{node}:{replica}"), node))
+        ring.sort()
+        self._hashes = [point for point, _ in ring]
+        self._nodes = [node for _, node in ring]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int(hashlib.md5(key.encode()).hexdigest(), 16)
+
+    def node(self, key: str) -> int:
+        """Returns the node the key belongs to"""
+        index = bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+
+class TenantContext:
+    """Switches the settings, clients and databases of the process between
+    tenants. The Notion clients and Google credentials are kept per tenant so
+    their connections and access tokens are reused between cycles.
+    """
+
+    notion_clients: Dict[str, notion.FastNotionClient]
+    google_credentials: Dict[str, Credentials]
+
+    def __init__(self) -> None:
+        self.notion_clients = {}
+        self.google_credentials = {}
+
+    def activate(self, tenant: Tenant):
+        settings.notion_secret = tenant.notion_secret
+        settings.notion_task_db = tenant.notion_task_db
+        settings.notion_bucket_db = tenant.notion_bucket_db
+        settings.google_default_tasklist = tenant.google_default_tasklist
+        settings.status_mapper = tenant.status_mapper
+
+        if tenant.tenant_id not in self.notion_clients:
+            self.notion_clients[tenant.tenant_id] = notion.create_notion_client()
+        notion.use_notion_client(self.notion_clients[tenant.tenant_id])
+        notion.use_notion_databases(tenant.notion_task_db, tenant.notion_bucket_db)
+
+        credentials = self.google_credentials.get(tenant.tenant_id)
+        if not credentials or credentials.refresh_token != tenant.google_token.get("refresh_token"):
+            # New tenant, or the tenant has been authorized again
+            credentials = Credentials.from_authorized_user_info(tenant.google_token, SCOPES)
+            self.google_credentials[tenant.tenant_id] = credentials
+        use_google_credentials(credentials)
+        google_tasklists.clear()
+
+        use_mongo_db(tenant.mongo_db or f"{settings.mongo_db}-{tenant.tenant_id}")
+
+    def save_credentials(self, tenant: Tenant):
+        """Stores the Google token of the tenant if it has been refreshed, so
+        the next worker to sync the tenant doesn't refresh it again"""
+        credentials = self.google_credentials.get(tenant.tenant_id)
+        if not credentials or credentials.token == tenant.google_token.get("token"):
+            return
+
+        tenant.google_token = json.loads(credentials.to_json())
+        use_mongo_db(settings.mongo_db)
+        TenantRepository._get_collection().update_one(
+            {"tenant_id": tenant.tenant_id}, {"$set": {"google_token": tenant.google_token}})
+
+
+def shard_worker(index: int, workers: int, sleep_time: int):
+    """Syncs the tenants hashed onto this worker, forever. The tenants are
+    reloaded every round, so new tenants are picked up without a restart.
+    """
+    # Don't reuse the MongoDB connection of the parent process
+    connect_mongo(mongo_uri, settings.mongo_db)
+    ring = HashRing(range(workers))
+    context = TenantContext()
+    profiler = CycleProfiler(directory=os.path.join(settings.profile_dir, f"worker-{index}"))
+    # Each tenant keeps its syncers, they remember which edits were synced
+    syncers: Dict[str, Tuple[NotionSyncer, GoogleSyncer]] = {}
+
+    while True:
+        use_mongo_db(settings.mongo_db)
+        tenants: List[Tenant] = [
+            tenant for tenant in TenantRepository.find()
+            if ring.node(tenant.tenant_id) == index
+        ]
+        logger.info(f"Worker {index} syncing {len(tenants)} tenant(s)")
+
+        with profiler.cycle():
+            for tenant in tenants:
+                # Replicas running the same shard take turns, whoever holds the
+                # lease of the tenant syncs it
+                lease = LeaseKeeper(f"tenant:{tenant.tenant_id}")
+                if not lease.acquire():
+                    continue
+
+                try:
+                    context.activate(tenant)
+                    Outbox.lease = lease.lease
+                    Outbox.drain()
+                    if tenant.tenant_id not in syncers:
+                        syncers[tenant.tenant_id] = (NotionSyncer(), GoogleSyncer())
+                    notion_syncer, google_syncer = syncers[tenant.tenant_id]
+                    notion_syncer.sync()
+                    google_syncer.sync()
+                except Exception as e:
+                    logger.error(f'Could not sync tenant "{tenant.tenant_id}": {e}')
+                finally:
+                    Outbox.lease = None
+                    lease.release()
+                    try:
+                        context.save_credentials(tenant)
+                    except Exception as e:
+                        logger.error(f'Could not save the Google token of tenant "{tenant.tenant_id}": {e}')
+
+        sleep(sleep_time)
+
+
+def run_workers(workers: int, sleep_time: int):
+    """Starts one worker process per shard and waits for them. Each worker has
+    its own rate limits, clients and connections.
+    """
+    mp_context = multiprocessing.get_context("fork")
+    processes = [
+        mp_context.Process(
+            target=shard_worker,
+            args=(index, workers, sleep_time),
+            name=f"tenant-worker-{index}"
+        )
+        for index in range(workers)
+    ]
+
+    for process in processes:
+        process.start()
+
+    for process in processes:
+        process.join()
@@ -1,6 +1,9 @@
+import httplib2
 import pytest
 from datetime import datetime
+from googleapiclient.errors import HttpError
 
+from app.models import google
 from app.models.google import GoogleTask, GoogleStatus
 from app.config import settings
 
@@ -35,4 +38,44 @@ def setup_tasks():
     yield
     child_task.google_delete()
     task.google_delete()
-    print("teardown")
\ No newline at end of file
+    print("teardown")
+
+
+class FailingGoogleRequest:
+    """A Google request that fails with the given HTTP status"""
+
+    def __init__(self, status: int) -> None:
+        self.status = status
+        self.headers = {}
+
+    def execute(self):
+        raise HttpError(httplib2.Response({"status": self.status}), b"")
+
+
+class FailingGoogleClient:
+    """A Google client whose task requests fail with the given HTTP status"""
+
+    def __init__(self, status: int) -> None:
+        self.status = status
+        self.requests = []
+
+    def tasks(self):
+        return self
+
+    def get(self, **kwargs):
+        self.requests.append(FailingGoogleRequest(self.status))
+        return self.requests[-1]
+
+    patch = get
+
+
+@pytest.fixture
+def failing_google_client(monkeypatch):
+    """Sends the task requests to a FailingGoogleClient with the given HTTP
+    status instead of Google"""
+    def use_status(status: int) -> FailingGoogleClient:
+        client = FailingGoogleClient(status)
+        monkeypatch.setattr(google, "google_client", lambda: client)
+        return client
+
+    return use_status
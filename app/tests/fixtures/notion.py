@@ -1,7 +1,9 @@
+import httpx
 import pytest
 from datetime import datetime, timedelta, timezone
 
-from app.models.notion import NotionLabel, NotionTask, NotionTime, NotionStatus
+from app.models import notion
+from app.models.notion import NotionLabel, NotionTask, NotionTime, NotionStatus, create_notion_client, use_notion_client
 from app.config import settings
 
 
@@ -33,4 +35,19 @@ def setup_notion_test_tasks():
     yield parent_task, child_task
     child_task.notion_delete()
     parent_task.notion_delete()
-    print("Removing test tasks in Notion")
\ No newline at end of file
+    print("Removing test tasks in Notion")
+
+
+@pytest.fixture()
+def mock_notion_client():
+    """Sends the requests of the Notion client to the given handler instead
+    of Notion, the shared client is restored afterwards
+    """
+    shared_client = notion.notion_client
+
+    def use_handler(handler):
+        use_notion_client(create_notion_client(
+            httpx.Client(transport=httpx.MockTransport(handler))))
+
+    yield use_handler
+    use_notion_client(shared_client)
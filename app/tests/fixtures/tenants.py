@@ -0,0 +1,27 @@
+import pytest
+from mongomantic.core.database import MongomanticClient
+
+from app.models import google, notion
+from app.models.mongo import ExtendedRepository
+from app.tenants import TenantContext
+from app.config import settings
+
+
+@pytest.fixture()
+def tenant_context(monkeypatch):
+    """A TenantContext whose activations are undone afterwards. The settings,
+    clients and databases it switches are restored."""
+    for name in ["notion_secret", "notion_task_db", "notion_bucket_db", "google_default_tasklist", "status_mapper"]:
+        monkeypatch.setattr(settings, name, getattr(settings, name))
+    monkeypatch.setattr(notion, "notion_client", notion.notion_client)
+    monkeypatch.setattr(notion, "notion_tasks_db_id", notion.notion_tasks_db_id)
+    monkeypatch.setattr(notion.NotionTasks.Meta, "database_id", notion.NotionTasks.Meta.database_id)
+    monkeypatch.setattr(notion.NotionBuckets.Meta, "database_id", notion.NotionBuckets.Meta.database_id)
+    monkeypatch.setattr(google, "creds", google.creds)
+    monkeypatch.setattr(google.google_tasklists, "tasklists", google.google_tasklists.tasklists)
+    monkeypatch.setattr(google.google_tasklists, "listed", google.google_tasklists.listed)
+    monkeypatch.setattr(MongomanticClient, "db", MongomanticClient.db)
+    for repository in ExtendedRepository.__subclasses__():
+        monkeypatch.setattr(repository, "_indexes", getattr(repository, "_indexes", None), raising=False)
+
+    yield TenantContext()
@@ -0,0 +1,30 @@
+import pytest
+from datetime import datetime
+
+from app.backfill import Backfill, match_key, parent_first
+from app.models.mongo import LeaseRepository, Outbox
+from app.tests.fixtures import mongo_fixture
+from app.config import settings
+
+
+class TestBackfill:
+    def test_parents_come_first(self):
+        parents = {"child": "parent", "grandchild": "child", "parent": None, "other": "missing"}
+        levels = parent_first({task_id: task_id for task_id in parents}, parents.get)
+
+        assert levels == [["parent", "other"], ["child"], ["grandchild"]]
+
+    def test_match_key_ignores_time_of_day(self):
+        assert match_key("Task", "Dev", datetime(2022, 3, 1, 13)) == match_key("Task", "Dev", datetime(2022, 3, 1))
+        assert match_key("Task", "Dev", None) != match_key("Task", "Other", None)
+
+    def test_refuses_to_run_while_syncing(self, mongo_fixture):
+        LeaseRepository.acquire(f"database:{settings.notion_task_db}", "syncer", ttl=60)
+        backfill = Backfill()
+
+        with pytest.raises(RuntimeError):
+            backfill.run()
+        assert Outbox.lease is None
+        with pytest.raises(RuntimeError):
+            # The pool was shut down
+            backfill.pool.submit(print)
@@ -0,0 +1,29 @@
+import json
+import logging
+
+from app.config import JsonFormatter, SampleFilter
+
+
+def make_record(level=logging.DEBUG, **extra):
+    record = logging.makeLogRecord({
+        "name": "TaskSyncer.task", "levelno": level, "levelname": logging.getLevelName(level),
+        "msg": 'Syncing task "%s"', "args": ("Task",)})
+    record.__dict__.update(extra)
+    return record
+
+
+class TestLogging:
+    def test_json_formatter_keeps_extra_fields(self):
+        entry = json.loads(JsonFormatter().format(make_record(notion_id="notion-id")))
+
+        assert entry["message"] == 'Syncing task "Task"'
+        assert entry["level"] == "DEBUG"
+        assert entry["logger"] == "TaskSyncer.task"
+        assert entry["notion_id"] == "notion-id"
+
+    def test_sample_filter_keeps_warnings(self):
+        sample_filter = SampleFilter(0)
+
+        assert not sample_filter.filter(make_record(logging.INFO))
+        assert sample_filter.filter(make_record(logging.WARNING))
+        assert SampleFilter(1).filter(make_record(logging.DEBUG))
@@ -1,8 +1,11 @@
+import httplib2
 import pytest
+import threading
 from datetime import datetime
 
-from app.models.google import GoogleTaskList, GoogleTaskLists, GoogleTasks
-from app.tests.fixtures.google import test_task_template, child_task_template, setup_tasks
+from app.models import google
+from app.models.google import GoogleConflictError, GoogleTask, GoogleTaskList, GoogleTaskLists, GoogleTasks
+from app.tests.fixtures.google import test_task_template, child_task_template, setup_tasks, failing_google_client
 from app.config import settings
 
 
@@ -81,6 +84,17 @@ class TestGoogleTask:
 
         updated_task.google_delete()
 
+    def test_changed_fields(self):
+        task = test_task_template.update_from_params({"title": "New title", "parent": "parent-id"})
+
+        # The parent can't be patched, tasks are moved instead
+        assert task.changed_fields(test_task_template) == ["title"]
+        assert test_task_template.changed_fields(test_task_template) == []
+
+        # Timestamps and etags are not content
+        echo = test_task_template.update_from_params({"updated": datetime.now(), "etag": "etag"})
+        assert echo.changed_fields(test_task_template, fields=echo.Meta.content_fields) == []
+
 
 ######################## Test the GoogleTaskLists model ########################
 
@@ -106,3 +120,59 @@ class TestGoogleTasks:
     def test_list_all_tasks(self):
         tasks = list(GoogleTasks.list())
         assert len(tasks) > 0
+
+    def test_closing_the_listing_stops_the_fetches(self, monkeypatch):
+        stopped = threading.Event()
+
+        def list_pages(tasklist_id, **kwargs):
+            try:
+                while True:
+                    yield [{"id": "task", "title": "Task", "status": "needsAction"}]
+            finally:
+                stopped.set()
+
+        monkeypatch.setattr(google.google_tasklists, "tasklists", [GoogleTaskList(tasklist="tasklist", title="Tasklist")])
+        monkeypatch.setattr(google.google_tasklists, "listed", float("inf"))
+        monkeypatch.setattr(GoogleTasks, "list_pages", list_pages)
+
+        tasks = GoogleTasks.list()
+        assert next(tasks).google_id == "task"
+        tasks.close()
+        assert stopped.wait(5)
+
+
+class TestConditionalRequests:
+    task = GoogleTask(
+        google_id="google-id", etag="etag", title="Title", status="needsAction", tasklist="tasklist")
+
+    def test_fetch_not_modified(self, failing_google_client):
+        client = failing_google_client(304)
+
+        assert self.task.fetch() == self.task
+        assert client.requests[0].headers["If-None-Match"] == "etag"
+
+    def test_get_not_modified(self, failing_google_client):
+        failing_google_client(304)
+
+        assert GoogleTasks.get("tasklist", "google-id", etag="etag") is None
+
+    def test_save_conflict(self, failing_google_client):
+        client = failing_google_client(412)
+
+        with pytest.raises(GoogleConflictError):
+            self.task.google_save(fields=["title"])
+        assert client.requests[0].headers["If-Match"] == "etag"
+
+
+class TestDiscoveryDocument:
+    def test_failed_download_is_not_cached(self, tmp_path, monkeypatch):
+        cache_path = tmp_path / "discovery.json"
+        monkeypatch.setattr(google, "discovery_path", str(cache_path))
+        monkeypatch.setattr(google, "get_static_doc", lambda *args: None)
+        monkeypatch.setattr(
+            google.httplib2.Http, "request",
+            lambda self, uri, *args, **kwargs: (httplib2.Response({"status": 503}), b"Service Unavailable"))
+
+        with pytest.raises(RuntimeError):
+            google.discovery_document.__wrapped__()
+        assert not cache_path.exists()
@@ -1,10 +1,11 @@
 import json
+import httpx
 import pytest
 from os import path
 from datetime import date, datetime, time, timedelta, timezone
 
 from app.models.notion import NotionTask, NotionTasks, NotionTime, NotionDatabaseModel
-from app.tests.fixtures.notion import parent_params, setup_notion_test_tasks
+from app.tests.fixtures.notion import parent_params, setup_notion_test_tasks, mock_notion_client
 from app.config import settings
 
 
@@ -33,6 +34,99 @@ class TestNotionTime():
         assert notion_time.has_time
         assert notion_time.dt == datetime.combine(date(year=2022, month=2, day=12), time(hour=13, tzinfo=timezone(timedelta(seconds=3600))))
 
+    def test_last_edited_str(self):
+        notion_time = NotionTime.from_notion("2022-02-04T19:01:00.000")
+        assert notion_time.has_time
+        assert notion_time.dt == datetime(year=2022, month=2, day=4, hour=19, minute=1)
+
+        # Parsed timestamps are cached, but every call gets its own instance
+        assert NotionTime.from_notion("2022-02-04T19:01:00.000") is not notion_time
+
+
+########################### Test the Notion client #############################
+
+class TestNotionClient:
+    def test_injected_http_client(self, mock_notion_client):
+        notion_response = load_notion_json("notion_task_page_response.json")
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            assert request.url.path == f"/v1/pages/{notion_response['id']}"
+            return httpx.Response(200, json=notion_response)
+
+        mock_notion_client(handler)
+        task = NotionTask(
+            notion_id=notion_response["id"],
+            database_id=settings.notion_task_db
+        ).fetch()
+
+        assert task.title == notion_response["properties"]["Task"]["title"][0]["plain_text"]
+
+    def test_query_pages_keep_filter(self, mock_notion_client):
+        notion_response = load_notion_json("notion_task_page_response.json")
+        task_filter = {"property": "Status", "select": {"is_not_empty": True}}
+        requests = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            body = json.loads(request.content)
+            requests.append((request, body))
+            return httpx.Response(200, json={
+                "results": [notion_response],
+                "has_more": "start_cursor" not in body,
+                "next_cursor": "cursor"
+            })
+
+        mock_notion_client(handler)
+        tasks = list(NotionTasks().list(filter=task_filter, filter_properties=["title"]))
+
+        assert len(tasks) == 2
+        assert len(requests) == 2
+        for request, body in requests:
+            assert body["filter"] == task_filter
+            assert body["page_size"] == 100
+            assert request.url.params.get_list("filter_properties") == ["title"]
+        assert requests[1][1]["start_cursor"] == "cursor"
+
+    def test_partial_update(self, mock_notion_client):
+        notion_response = load_notion_json("notion_task_page_response.json")
+        bodies = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            bodies.append(json.loads(request.content))
+            return httpx.Response(200, json=notion_response)
+
+        task = NotionTask.from_notion(notion_response).update_from_params({"title": "New title"})
+
+        mock_notion_client(handler)
+        task.notion_save(fields=["title"])
+
+        assert list(bodies[0]) == ["properties"]
+        assert list(bodies[0]["properties"]) == ["Task"]
+
+    def test_list_unsyncable_ids(self, mock_notion_client):
+        task_filter = {"property": "Bucket", "relation": {"does_not_contain": "bucket"}}
+        bodies = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            if request.method == "GET":
+                # The property ids of the database
+                return httpx.Response(200, json={"properties": {"Task": {"id": "title"}}})
+            body = json.loads(request.content)
+            bodies.append(body)
+            return httpx.Response(200, json={
+                "results": [{"id": f"task-{len(bodies)}"}],
+                "has_more": "start_cursor" not in body,
+                "next_cursor": "cursor"
+            })
+
+        mock_notion_client(handler)
+        assert list(NotionTasks().list_unsyncable_ids(filter=task_filter)) == ["task-1", "task-2"]
+        assert bodies[0]["filter"] == {"or": [
+            {"property": "Bucket", "relation": {"is_empty": True}},
+            {"property": "Status", "select": {"is_empty": True}},
+            task_filter,
+        ]}
+        assert bodies[1]["start_cursor"] == "cursor"
+
 
 ##################### Test the NotionDatabaseModel model #######################
 
@@ -111,6 +205,22 @@ class TestNotionTask:
         for field in correct_kwargs.keys():
             assert kwargs[field] == correct_kwargs[field]
 
+    def test_long_notes(self):
+        notion_response = load_notion_json("notion_task_page_response.json")
+        task = NotionTask.from_notion(notion_response)
+        task.notes = "x" * 4500
+
+        rich_text = task.to_notion_kwargs()["properties"]["Notes"]["rich_text"]
+        assert [len(text["text"]["content"]) for text in rich_text] == [2000, 2000, 500]
+
+        # Notes split over several text objects are joined when parsed
+        notion_response["properties"]["Notes"]["rich_text"] = [
+            {"plain_text": text["text"]["content"]} for text in rich_text
+        ]
+        parsed_task = NotionTask.from_notion(notion_response)
+        assert parsed_task.notes == task.notes
+        assert parsed_task.notes_hash != NotionTask.from_notion(load_notion_json("notion_task_page_response.json")).notes_hash
+
     def test_create_and_remove_task_in_notion(self):
         synced_time = datetime.now()
         task = NotionTask(
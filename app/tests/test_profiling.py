@@ -0,0 +1,25 @@
+import pstats
+
+from app.profiling import CycleProfiler
+
+
+class TestCycleProfiler:
+    def test_profiles_the_first_cycles(self, tmp_path):
+        profiler = CycleProfiler(cycles=1, directory=str(tmp_path))
+
+        with profiler.cycle():
+            sorted(range(1000), key=str)
+        with profiler.cycle():
+            sorted(range(1000), key=str)
+
+        profiles = list(tmp_path.glob("*.pstats"))
+        assert profiler.profiled == 1
+        assert len(profiles) == 1
+        assert pstats.Stats(str(profiles[0])).total_calls > 0
+
+    def test_disabled_by_default(self, tmp_path):
+        profiler = CycleProfiler(cycles=0, directory=str(tmp_path))
+        with profiler.cycle():
+            pass
+
+        assert not tmp_path.exists() or not list(tmp_path.iterdir())
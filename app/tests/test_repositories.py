@@ -1,7 +1,11 @@
-from app.models.mongo import GoogleTaskRepository, NotionTaskRepository
+import pytest
+from datetime import datetime, timedelta
+
+from app.models.mongo import GoogleTaskRepository, NotionTaskRepository, LeaseRepository, Outbox, OutboxEntry, OutboxRepository
 from app.tests.fixtures import mongo_fixture
 from app.tests.fixtures.notion import setup_notion_test_tasks
-from app.models.google import GoogleStatus, GoogleTask
+from app.tests.fixtures.google import failing_google_client
+from app.models.google import GoogleConflictError, GoogleStatus, GoogleTask
 from app.models.notion import NotionTask
 from app.config import settings
 
@@ -38,3 +42,99 @@ class TestGoogleTaskRepository:
         assert saved_task.dict(exclude={"id"}) == task_before_save.dict(exclude={"id"})
 
         task_before_save.google_delete()
+
+
+class TestOutbox:
+    def test_replay_after_provider_write(self, mongo_fixture):
+        # An entry left behind by a crash right after the Google write
+        google_task = GoogleTask(
+            google_id="google-id",
+            notion_id="notion-id",
+            title="Testtask",
+            status=GoogleStatus.todo,
+            tasklist=settings.google_default_tasklist
+        )
+        notion_task = NotionTask(
+            notion_id="notion-id",
+            title="Testtask",
+            database_id=settings.notion_task_db
+        )
+        OutboxRepository.save(OutboxEntry(
+            key="google:notion_id=notion-id",
+            provider="google",
+            task=google_task.dict(exclude={"id", "google_id"}),
+            linked=notion_task.dict(exclude={"id"}),
+            result=google_task.dict(exclude={"id"}),
+            created=datetime.now()
+        ))
+
+        # Replaying does not write to Google again and is idempotent
+        Outbox.drain()
+        Outbox.drain()
+
+        assert len(list(OutboxRepository.find())) == 0
+        assert len(list(GoogleTaskRepository.find())) == 1
+        internal_notion_tasks = list(NotionTaskRepository.find())
+        assert len(internal_notion_tasks) == 1
+        assert internal_notion_tasks[0].google_id == "google-id"
+
+    def test_conflict_drops_the_entry(self, mongo_fixture, failing_google_client):
+        failing_google_client(412)
+        google_task = GoogleTask(
+            google_id="google-id",
+            etag="etag",
+            title="Testtask",
+            status=GoogleStatus.todo,
+            tasklist=settings.google_default_tasklist
+        )
+
+        # The task is merged again in the next cycle instead
+        with pytest.raises(GoogleConflictError):
+            Outbox.write("google", google_task, fields=["title"])
+        assert len(list(OutboxRepository.find())) == 0
+
+    def test_stale_entries_are_dropped(self, mongo_fixture):
+        google_task = GoogleTask(
+            google_id="google-id",
+            title="Testtask",
+            status=GoogleStatus.todo,
+            tasklist=settings.google_default_tasklist
+        )
+        OutboxRepository.save(OutboxEntry(
+            key="google:google-id",
+            provider="google",
+            task=google_task.dict(exclude={"id"}),
+            created=datetime.now() - timedelta(hours=1)
+        ))
+        OutboxRepository.save(OutboxEntry(
+            key="google:other-google-id",
+            provider="google",
+            task=google_task.copy(update={"google_id": "other-google-id"}).dict(exclude={"id"}),
+            attempts=settings.outbox_max_attempts,
+            created=datetime.now()
+        ))
+        # The task has changed on Google since the write was stored
+        GoogleTaskRepository.save(google_task.copy(update={"updated": datetime.utcnow()}))
+
+        # Neither entry is written to Google again
+        Outbox.drain()
+        assert len(list(OutboxRepository.find())) == 0
+
+
+class TestLeaseRepository:
+    def test_lease(self, mongo_fixture):
+        lease = LeaseRepository.acquire("test-resource", "replica-1", ttl=60)
+        assert lease.token == 1
+        assert LeaseRepository.holds(lease)
+
+        # Held by another replica
+        assert LeaseRepository.acquire("test-resource", "replica-2", ttl=60) is None
+        assert LeaseRepository.renew(lease, ttl=60)
+
+        LeaseRepository.release(lease)
+        new_lease = LeaseRepository.acquire("test-resource", "replica-2", ttl=60)
+        assert new_lease.token == 2
+
+        # The old owner is fenced off
+        assert not LeaseRepository.holds(lease)
+        assert not LeaseRepository.renew(lease, ttl=60)
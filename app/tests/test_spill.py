@@ -0,0 +1,45 @@
+import os
+
+from app.config import settings
+from app.spill import SpillDict, SpillSet
+
+
+class TestSpill:
+    def test_set_spills_above_budget(self, monkeypatch):
+        monkeypatch.setattr(settings, "memory_budget", 0.01)
+        ids = SpillSet()
+        for i in range(200):
+            ids.add(f"task-{i}")
+        ids.add("task-0")
+
+        assert ids.spilled
+        assert len(ids) == 200
+        assert "task-199" in ids and "task-200" not in ids
+        assert sorted(ids) == sorted(f"task-{i}" for i in range(200))
+
+        path = ids._path
+        ids.close()
+        assert not os.path.exists(path)
+
+    def test_dict_stays_in_memory_without_budget(self, monkeypatch):
+        monkeypatch.setattr(settings, "memory_budget", 0)
+        writes = SpillDict()
+        for i in range(200):
+            writes[("google", str(i))] = {"fields": ["title"]}
+
+        assert not writes.spilled
+        assert writes[("google", "1")] == {"fields": ["title"]}
+
+    def test_dict_spills_above_budget(self, monkeypatch):
+        monkeypatch.setattr(settings, "memory_budget", 0.01)
+        writes = SpillDict()
+        for i in range(200):
+            writes[("google", str(i))] = {"fields": ["title"]}
+        writes[("google", "1")] = {"fields": None}
+
+        assert writes.spilled
+        assert len(writes) == 200
+        assert writes[("google", "1")] == {"fields": None}
+        assert writes.get(("notion", "1")) is None
+        assert dict(writes.items())[("google", "2")] == {"fields": ["title"]}
+        writes.close()
@@ -1,6 +1,20 @@
-from app.models.mongo import NotionTaskRepository, GoogleTaskRepository
+import httplib2
+import httpx
+import pytest
+from datetime import datetime, timedelta
+from googleapiclient.errors import HttpError
+from notion_client.errors import APIErrorCode, APIResponseError
+
+from app.models.mongo import GoogleTaskRepository, LeaseLostError, LeaseRepository, NotionTaskRepository, Outbox
 from app.models.notion import NotionBuckets, NotionTask, NotionTasks
-from app.models.google import GoogleTasks, GoogleTask
+from app.models.google import GoogleStatus, GoogleTasks, GoogleTask
+from app.syncers.buffer import WriteBuffer
+from app.syncers.merge import three_way_merge
+from app.syncers.snapshot import Snapshot
+from app.syncers.plan import Plan
+from app.syncers.schedule import ScopeSchedule
+from app.syncers.priority import Budget, WorkQueue
+from app.syncers.tombstones import Tombstones, already_deleted
 from app.syncers.google import GoogleSyncer
 from app.syncers.notion import NotionSyncer
 from app.tests.fixtures import mongo_fixture
@@ -104,4 +118,307 @@ class TestNotionSyncer:
         assert len(list(GoogleTasks().list(tasklist_id=dev_tasklist))) == 0
         assert len(list(GoogleTaskRepository.find())) == 0
         assert len(list(NotionTaskRepository.find())) == 0
-        assert len(list(NotionTasks().list(filter=notion_tasks_filter))) == 0
\ No newline at end of file
+        assert len(list(NotionTasks().list(filter=notion_tasks_filter))) == 0
+
+
+class TestWriteBuffer:
+    def test_writes_are_merged(self):
+        buffer = WriteBuffer()
+        task = GoogleTask(
+            google_id="google-id",
+            title="Title",
+            notes="Notes",
+            status=GoogleStatus.todo,
+            tasklist=settings.google_default_tasklist
+        )
+
+        buffer.refresh("google", "google-id")
+        buffer.write("google", task.update_from_params({"title": "New title"}), fields=["title"])
+        buffer.write("google", task.update_from_params({"notes": "New notes"}), fields=["notes"])
+
+        assert len(buffer.writes) == 1
+        assert len(buffer.refreshes) == 0
+
+        pending_task = buffer.writes[("google", "google-id")]["task"]
+        assert pending_task.title == "New title"
+        assert pending_task.notes == "New notes"
+        assert buffer.writes[("google", "google-id")]["fields"] == ["title", "notes"]
+
+    def test_lost_lease_stops_the_flush(self, monkeypatch):
+        writes = []
+
+        def write(provider, task, linked=None, fields=None):
+            writes.append(task.google_id)
+            raise LeaseLostError("The lease of test-resource has been lost")
+
+        monkeypatch.setattr(Outbox, "write", write)
+        buffer = WriteBuffer()
+        for google_id in ["google-id-1", "google-id-2"]:
+            buffer.write("google", GoogleTask(
+                google_id=google_id, title="Title", status=GoogleStatus.todo,
+                tasklist=settings.google_default_tasklist))
+
+        with pytest.raises(LeaseLostError):
+            buffer.flush()
+        assert len(writes) == 1
+        assert len(buffer.writes) == 0
+
+
+class TestThreeWayMerge:
+    base = {"title": "Title", "notes": "Notes", "status": GoogleStatus.todo, "due": None}
+
+    def test_changes_on_both_sides_are_merged(self):
+        notion = self.base | {"title": "Notion title"}
+        google = self.base | {"status": GoogleStatus.done}
+
+        to_google, to_notion = three_way_merge(self.base, notion, google, notion_is_newer=True)
+
+        assert to_google == {"title": "Notion title"}
+        assert to_notion == {"status": GoogleStatus.done}
+
+    def test_conflicts_follow_the_policy(self):
+        notion = self.base | {"notes": "Notion notes"}
+        google = self.base | {"notes": "Google notes"}
+
+        settings.conflict_policies = {"notes": "google"}
+        try:
+            to_google, to_notion = three_way_merge(self.base, notion, google, notion_is_newer=True)
+        finally:
+            settings.conflict_policies = {}
+
+        assert to_google == {}
+        assert to_notion == {"notes": "Google notes"}
+
+        to_google, to_notion = three_way_merge(self.base, notion, google, notion_is_newer=True)
+        assert to_google == {"notes": "Notion notes"}
+        assert to_notion == {}
+
+
+class TestSnapshot:
+    def test_diff(self, mongo_fixture):
+        def google_task(number: int, title="Title"):
+            return GoogleTask(
+                google_id=f"google-id-{number}",
+                title=title,
+                status=GoogleStatus.todo,
+                tasklist=settings.google_default_tasklist,
+                updated=datetime(year=2022, month=3, day=1)
+            )
+
+        for number in [1, 2, 3]:
+            GoogleTaskRepository.save(google_task(number))
+
+        snapshot = Snapshot("google")
+        list(snapshot.changed([google_task(1), google_task(2)]))
+        snapshot.commit()
+
+        # Only the changed task is synced again, the task that is not listed
+        # anymore is removed
+        snapshot = Snapshot("google")
+        changed_tasks = list(snapshot.changed([google_task(1), google_task(2, title="New title")]))
+
+        assert [task.google_id for task in changed_tasks] == ["google-id-2"]
+        assert changed_tasks[0].title == "New title"
+        assert list(snapshot.removed_ids()) == ["google-id-3"]
+        assert set(snapshot.collection.find_one({"_id": "google-id-1"})) == {"_id", "updated", "hash"}
+
+        # A task that could not be synced is synced again, but stays listed
+        snapshot.forget("google-id-1")
+        assert list(snapshot.removed_ids()) == ["google-id-3"]
+        snapshot.commit()
+        snapshot = Snapshot("google")
+        assert [task.google_id for task in snapshot.changed([google_task(1)])] == ["google-id-1"]
+
+
+
+class TestTombstones:
+    def test_grace_and_guard(self, mongo_fixture):
+        for number in range(1, 21):
+            GoogleTaskRepository.save(GoogleTask(
+                google_id=f"google-id-{number}",
+                title="Title",
+                status=GoogleStatus.todo,
+                tasklist=settings.google_default_tasklist,
+                updated=datetime(year=2022, month=3, day=1)
+            ))
+        tombstones = Tombstones("google")
+
+        # Most of the tasks missing at once looks like a truncated listing
+        missing_ids = [f"google-id-{number}" for number in range(6, 21)]
+        assert tombstones.record(missing_ids, set(), 20) == 0
+
+        grace = settings.tombstone_grace
+        try:
+            settings.tombstone_grace = 600
+            assert tombstones.record(["google-id-20"], set(), 20) == 1
+            assert tombstones.sweep(sync_other=False) == 0
+
+            # Still missing after the grace window
+            settings.tombstone_grace = 0
+            tombstones.record(["google-id-20"], set(), 20)
+            assert tombstones.sweep(sync_other=False) == 1
+        finally:
+            settings.tombstone_grace = grace
+
+        assert len(list(GoogleTaskRepository.find())) == 19
+
+    def test_listed_tasks_start_over(self, monkeypatch, mongo_fixture):
+        monkeypatch.setattr(settings, "tombstone_grace", 600)
+        tombstones = Tombstones("google")
+        tombstones.record(["google-id-1"], set(), 20)
+
+        # Listed again in a cycle that was out of budget
+        tombstones.clear_listed({"google-id-1"})
+        assert tombstones.collection.count_documents({"task_id": "google-id-1"}) == 0
+
+    def test_sweep_is_capped(self, monkeypatch, mongo_fixture):
+        monkeypatch.setattr(settings, "tombstone_batch", 2)
+        monkeypatch.setattr(settings, "tombstone_batches", 2)
+        monkeypatch.setattr(settings, "max_delete_ratio", 1)
+        for number in range(1, 6):
+            GoogleTaskRepository.save(GoogleTask(
+                google_id=f"google-id-{number}",
+                title="Title",
+                status=GoogleStatus.todo,
+                tasklist=settings.google_default_tasklist,
+                updated=datetime(year=2022, month=3, day=1)
+            ))
+        tombstones = Tombstones("google")
+        tombstones.record([f"google-id-{number}" for number in range(1, 6)], set(), 5)
+
+        # Even without a cycle budget, the rest is left for the next cycles
+        assert tombstones.sweep(sync_other=False) == 4
+        assert tombstones.sweep(sync_other=False) == 1
+
+    def test_already_deleted(self):
+        def notion_error(status: int, code: APIErrorCode, message: str) -> APIResponseError:
+            return APIResponseError(httpx.Response(status), message, code)
+
+        assert already_deleted(HttpError(httplib2.Response({"status": 404}), b"Not Found"))
+        assert not already_deleted(HttpError(httplib2.Response({"status": 503}), b"Service Unavailable"))
+        assert already_deleted(notion_error(404, APIErrorCode.ObjectNotFound, "Could not find block"))
+        assert already_deleted(notion_error(
+            400, APIErrorCode.ValidationError, "Can't edit block that is archived. You must unarchive the block before editing."))
+        assert not already_deleted(notion_error(429, APIErrorCode.RateLimited, "Rate limited"))
+
+    def test_sweep_stops_without_lease(self, monkeypatch, mongo_fixture):
+        lease = LeaseRepository.acquire("test-resource", "replica-1", ttl=0)
+        # Another replica took over
+        assert LeaseRepository.acquire("test-resource", "replica-2", ttl=60)
+        monkeypatch.setattr(Outbox, "lease", lease)
+
+        with pytest.raises(LeaseLostError):
+            Tombstones("google").sweep()
+
+
+class TestPlan:
+    def test_calls_and_time(self):
+        plan = Plan()
+        plan.add_listing("notion", [250])
+        plan.add_listing("google", [0, 120])
+        plan.add("create", "google", "New task")
+        plan.add("update", "notion", "Changed task", reads={"notion": 1})
+
+        assert plan.calls == {"notion": 5, "google": 4}
+
+        notion_rate_limit, google_rate_limit = settings.notion_rate_limit, settings.google_rate_limit
+        settings.notion_rate_limit, settings.google_rate_limit = 5, 2
+        try:
+            assert plan.estimated_seconds() == 3
+        finally:
+            settings.notion_rate_limit, settings.google_rate_limit = notion_rate_limit, google_rate_limit
+
+
+class TestScopeSchedule:
+    def test_due_and_wait(self):
+        schedule = ScopeSchedule(60, intervals={"Someday": 3600})
+        start = datetime(2022, 3, 1, 12)
+        schedule.titles = ["Inbox", "Someday"]
+
+        assert schedule.due(schedule.titles, start) == ["Inbox", "Someday"]
+        schedule.last_synced = {"Inbox": start, "Someday": start}
+
+        later = start + timedelta(seconds=90)
+        assert schedule.due(schedule.titles, later) == ["Inbox"]
+        assert schedule.wait(start + timedelta(seconds=20)) == 40
+        assert schedule.wait(later) == 0
+
+
+class TestWorkQueue:
+    def list_tasks(self, now: datetime, listed: list):
+        for google_id, updated, due in [
+            ("old", now - timedelta(days=3), None),
+            ("edited", now - timedelta(minutes=1), None),
+            ("due-later", now - timedelta(days=1), now + timedelta(days=7)),
+            ("due-soon", now - timedelta(days=2), now + timedelta(hours=2)),
+            ("older-edit", now - timedelta(minutes=3), None),
+        ]:
+            listed.append(google_id)
+            yield GoogleTask(
+                google_id=google_id, title=google_id, tasklist="tasklist", status="needsAction",
+                updated=updated, due=due)
+
+    def test_urgent_tasks_first(self, monkeypatch):
+        monkeypatch.setattr(settings, "cycle_budget", 60)
+        now, listed = datetime.utcnow(), []
+
+        queue = iter(WorkQueue(
+            self.list_tasks(now, listed), "google_id", edited_since=lambda task: now - timedelta(minutes=5)))
+        # Urgent tasks are synced while the rest is still being listed
+        task, urgent = next(queue)
+        assert (task.google_id, urgent) == ("edited", True)
+        assert listed == ["old", "edited"]
+
+        order = [(task.google_id, urgent) for task, urgent in queue]
+        assert order == [
+            ("due-soon", True), ("older-edit", True),
+            ("due-later", False), ("old", False),
+        ]
+
+    def test_listing_order_without_budget(self, monkeypatch):
+        monkeypatch.setattr(settings, "cycle_budget", 0)
+        now, listed = datetime.utcnow(), []
+
+        queue = WorkQueue(
+            self.list_tasks(now, listed), "google_id", edited_since=lambda task: now - timedelta(minutes=5))
+        order = [(task.google_id, urgent) for task, urgent in queue]
+        assert order == [
+            ("old", False), ("edited", True), ("due-later", False),
+            ("due-soon", True), ("older-edit", True),
+        ]
+
+    def test_old_and_completed_tasks_are_not_urgent(self):
+        now = datetime.utcnow()
+        tasks = [
+            GoogleTask(
+                google_id=google_id, title=google_id, tasklist="tasklist", status=status,
+                updated=now - timedelta(days=30), due=due)
+            for google_id, status, due in [
+                ("completed-long-ago", GoogleStatus.done, now - timedelta(days=20)),
+                ("completed-today", GoogleStatus.done, now),
+                ("overdue-for-weeks", GoogleStatus.todo, now - timedelta(days=20)),
+                ("overdue-since-today", GoogleStatus.todo, now - timedelta(hours=2)),
+            ]
+        ]
+
+        order = [(task.google_id, urgent) for task, urgent in WorkQueue(tasks, "google_id")]
+        assert dict(order) == {
+            "completed-long-ago": False, "completed-today": False,
+            "overdue-for-weeks": False, "overdue-since-today": True,
+        }
+
+    def test_budget(self):
+        assert not Budget(0).exhausted()
+        assert Budget(-1).exhausted()
+
+    def test_edited_since_by_tasklist(self):
+        now = datetime.utcnow()
+        syncer = GoogleSyncer()
+        syncer.edited_since = {None: now - timedelta(hours=1), "synced-later": now}
+
+        def task(tasklist: str) -> GoogleTask:
+            return GoogleTask(google_id="task", title="Task", tasklist=tasklist, status="needsAction")
+
+        assert syncer.task_edited_since(task("synced-later")) == now
+        assert syncer.task_edited_since(task("other")) == now - timedelta(hours=1)
+        assert GoogleSyncer().task_edited_since(task("other")) is None
@@ -0,0 +1,39 @@
+from app.models import google
+from app.models.mongo import Tenant
+from app.tenants import HashRing
+from app.tests.fixtures.tenants import tenant_context
+
+
+class TestHashRing:
+    def test_tenants_are_spread_over_workers(self):
+        ring = HashRing(range(4))
+        workers = {ring.node(f"tenant-{i}") for i in range(100)}
+        assert workers == {0, 1, 2, 3}
+
+    def test_adding_a_worker_moves_few_tenants(self):
+        ring = HashRing(range(4))
+        bigger_ring = HashRing(range(5))
+        tenant_ids = [f"tenant-{i}" for i in range(1000)]
+
+        moved = [t for t in tenant_ids if ring.node(t) != bigger_ring.node(t)]
+        assert len(moved) < len(tenant_ids) / 3
+        # Tenants only move to the new worker
+        assert all(bigger_ring.node(t) == 4 for t in moved)
+
+
+class TestTenantContext:
+    def test_google_credentials_are_kept_per_tenant(self, tenant_context):
+        tenant = Tenant(
+            tenant_id="tenant", notion_secret="secret", notion_task_db="tasks", notion_bucket_db="buckets",
+            google_token={"token": "token", "refresh_token": "refresh", "client_id": "id", "client_secret": "secret"},
+            status_mapper=[])
+
+        tenant_context.activate(tenant)
+        credentials = google.google_credentials()
+        tenant_context.activate(tenant)
+        assert google.google_credentials() is credentials
+
+        # Authorized again
+        tenant.google_token = {**tenant.google_token, "refresh_token": "new-refresh"}
+        tenant_context.activate(tenant)
+        assert google.google_credentials() is not credentials
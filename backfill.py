@@ -0,0 +1,5 @@
+from app.backfill import Backfill
+
+# Initial import of an existing workspace, run it once before starting the
+# syncer. Running it again resumes an interrupted import.
+Backfill().run()